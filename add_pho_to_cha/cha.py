@@ -1,11 +1,18 @@
+import io
 import re
 from collections import defaultdict
 
+import numpy as np
+import pandas as pd
+
 from cha_re import main_tier_content_pattern, annotation as annotation_pattern, ends_with_a_timestamp,\
-    transcription_pattern
+    transcription_pattern, timestamp_times
 
 
 TRANSCRIPTION_LABEL = '%pho:'
+transcription_regex = re.compile(transcription_pattern)
+timestamp_regex = re.compile(timestamp_times)
+TIER_TIMES_COLUMNS = ['tier_index', 'time_start', 'time_end']
 
 
 class MainTier(object):
@@ -22,6 +29,9 @@ class MainTier(object):
         self.label = None
         self.contents = None
         self.sub_tiers = None  # A list of SubTier objects
+        # In milliseconds, from the timestamp(s) at the end of the content lines. None if there are no timestamps.
+        self.time_start = None
+        self.time_end = None
 
         # Parse out the annotated words
         self.words_uttered_by = dict()
@@ -33,9 +43,20 @@ class MainTier(object):
         # Transcriptions
         self.transcriptions = None
         self.transcription_kinds = None
+        # The result of the last update_pho call
+        self.pho_status = None
+
+        # If something breaks on the way, write it down and continue ahead. Errors are kept by the step they happened
+        # at so that they can be forgotten when the step is redone.
+        self.errors_by_step = defaultdict(list)
 
-        # If something breaks on the way, write it down and continue ahead
-        self.errors = list()
+        # Fingerprints of the contents each piece of the derived state above was derived from, see
+        # process_for_phonetic_transcription
+        self.derived_from = dict()
+
+    @property
+    def errors(self):
+        return [error for errors in self.errors_by_step.values() for error in errors]
 
     def consume(self, line):
         """
@@ -88,10 +109,19 @@ class MainTier(object):
         self.label = starts[0]
         # The second parts of the lines are the content lines
         self.contents = ends
+        self._parse_times()
 
         # Remove unparsed
         self.main_tier_lines_unparsed = None
 
+    def _parse_times(self):
+        # Tiers split over several lines have a timestamp on each line, the tier spans all of them
+        times = [(int(match.group('start')), int(match.group('end')))
+                 for content_line in self.contents for match in timestamp_regex.finditer(content_line)]
+        if times:
+            starts, ends = zip(*times)
+            self.time_start, self.time_end = min(starts), max(ends)
+
     def _parse_sub_tiers(self):
         self.sub_tiers = [SubTier.from_line(sub_tier_line) for sub_tier_line in self.sub_tiers_lines_unparsed]
         self.sub_tiers_lines_unparsed = None
@@ -127,6 +157,8 @@ class MainTier(object):
         # Do this just once if any words were found the first time
         if code in self.words_uttered_by:
             raise ValueError(f'Words uttered by {code} have already been extracted')
+        errors = self.errors_by_step[('words', code)]
+        self.derived_from[('words', code)] = self._words_fingerprint()
 
         # Don't do anything if the speaker code is not present at all
         if f'_{code}_' not in str(self):
@@ -138,7 +170,7 @@ class MainTier(object):
             # then find all words and speakers within them
             parsed = re.match(main_tier_content_pattern, content_line)
             if not parsed:
-                self.errors.append(f'The following line could not be parsed:\n{content_line}')
+                errors.append(f'The following line could not be parsed:\n{content_line}')
                 continue
 
             annotations = parsed.group('annotations')
@@ -154,35 +186,105 @@ class MainTier(object):
                                                               list(speaker_annotids))
 
         if code not in self.words_uttered_by:
-            self.errors.append(f'Code "{code} found but no annotated words could be identified. Probably a bug.')
+            errors.append(f'Code "{code} found but no annotated words could be identified. Probably a bug.')
 
     def extract_phonetic_transcriptions(self):
+        # Can be called again after the pho subtier changes, the previous results are dropped
+        self.transcriptions = None
+        self.transcription_kinds = None
+        errors = self.errors_by_step['transcriptions'] = list()
+        self.derived_from['transcriptions'] = self._transcriptions_fingerprint()
+
         transcription_subtiers = self.sub_tiers_by_label[TRANSCRIPTION_LABEL]
         if len(transcription_subtiers) == 0:
             return
         if len(transcription_subtiers) > 1:
-            self.errors.append('Multiple transcription subtiers')
+            errors.append('Multiple transcription subtiers')
             return
 
         contents = self.sub_tiers_by_label[TRANSCRIPTION_LABEL][0].contents
         self.transcriptions = contents.split()
         self.transcription_kinds = [
-            'ipa' if re.match(transcription_pattern, transcription) else
+            'ipa' if transcription_regex.match(transcription) else
             'not transcribed' if transcription == '###' else
             'error'
             for transcription in self.transcriptions]
 
         for (transcription, kind) in zip(self.transcriptions, self.transcription_kinds):
             if kind == 'error':
-                self.errors.append(f'Unexpected transcription: {transcription}')
+                errors.append(f'Unexpected transcription: {transcription}')
 
     def categorize_subtiers(self):
         if len(self.sub_tiers_by_label) > 0:
             raise ValueError('Subtiers are already categorized')
 
+        self.derived_from['sub_tiers_by_label'] = self._sub_tiers_fingerprint()
         for sub_tier in self.sub_tiers:
             self.sub_tiers_by_label[sub_tier.label].append(sub_tier)
 
+    # # Incremental reprocessing
+    # Each piece of the derived state remembers the fingerprint of the contents it was derived from. After an in-place
+    # edit, only the pieces whose contents have changed are derived again.
+
+    def fingerprint(self):
+        """
+        :return: hash of the label, the contents, and the subtiers - everything that ends up in the file
+        """
+        return hash((self.label, tuple(self.contents),
+                     tuple((sub_tier.label, sub_tier.contents) for sub_tier in self.sub_tiers)))
+
+    def _words_fingerprint(self):
+        return hash(tuple(self.contents))
+
+    def _sub_tiers_fingerprint(self):
+        # The same SubTier objects must be in sub_tiers_by_label, hence the ids
+        return hash(tuple((id(sub_tier), sub_tier.label) for sub_tier in self.sub_tiers))
+
+    def _transcriptions_fingerprint(self):
+        return hash(tuple(sub_tier.contents for sub_tier in self.sub_tiers_by_label[TRANSCRIPTION_LABEL]))
+
+    def _forget_words(self, code):
+        self.words_uttered_by.pop(code, None)
+        self.annotid_of_words_uttered_by.pop(code, None)
+        self.errors_by_step.pop(('words', code), None)
+        self.derived_from.pop(('words', code), None)
+
+    def process_for_phonetic_transcription(self, speaker_code):
+        """
+        Extracts annotated words, categorizes subtiers, extracts transcriptions. Each step is only redone if its inputs
+        have changed since it was last done, and the whole tier is skipped if nothing has changed since the last call.
+        Does nothing if the speaker code is not in the annotations.
+        :param speaker_code: CHI, MOT, etc.
+        :return: bool - whether anything had to be redone
+        """
+        if not self.parsed:
+            self.parse()
+
+        fingerprint = self.fingerprint()
+        if self.derived_from.get(('tier', speaker_code)) == fingerprint:
+            return False
+
+        if not self.is_speaker_in_annotation(speaker_code=speaker_code):
+            # The speaker could have been there before an edit
+            self._forget_words(speaker_code)
+        else:
+            # extract annotated words
+            if self.derived_from.get(('words', speaker_code)) != self._words_fingerprint():
+                self._forget_words(speaker_code)
+                self.extract_words_by_speaker(speaker_code)
+
+            # categorize subtiers based on their labels
+            if self.derived_from.get('sub_tiers_by_label') != self._sub_tiers_fingerprint():
+                self.sub_tiers_by_label = defaultdict(list)
+                self.categorize_subtiers()
+
+            # Extract transcriptions
+            if self.derived_from.get('transcriptions') != self._transcriptions_fingerprint():
+                self.extract_phonetic_transcriptions()
+
+        self.derived_from[('tier', speaker_code)] = fingerprint
+        return True
+
     def is_speaker_in_annotation(self, speaker_code):
         return any(f'_{speaker_code}_' in content_line for content_line in self.contents)
 
@@ -190,8 +292,13 @@ class MainTier(object):
         """
         Checks the pho subtier against the annotated words uttered by speaker_code
         :param speaker_code: CHI, MOT, etc.
-        :return: str - result of the operation - what's been updated/added or an error message
+        :return: str - result of the operation - what's been updated/added or an error message. Also saved to
+        self.pho_status.
         """
+        self.pho_status = self._update_pho(speaker_code)
+        return self.pho_status
+
+    def _update_pho(self, speaker_code):
         if not self.is_speaker_in_annotation(speaker_code):
             return f'{speaker_code} not in annotation'
 
@@ -239,6 +346,30 @@ class MainTier(object):
         if m_transcribed == n_words:
             return 'all transcribed'
 
+    def set_pho_contents(self, contents):
+        """
+        Sets the contents of the pho subtier, adds the subtier first if there isn't one. Transcriptions are
+        re-extracted.
+        :param contents: new contents including the line ending
+        :return: bool - whether anything has changed
+        """
+        pho_subtiers = self.sub_tiers_by_label[TRANSCRIPTION_LABEL]
+        if len(pho_subtiers) > 1:
+            raise ValueError('Multiple transcription subtiers')
+
+        if len(pho_subtiers) == 0:
+            pho_subtier = SubTier(label=TRANSCRIPTION_LABEL, contents=contents)
+            self.sub_tiers = [pho_subtier] + self.sub_tiers
+            pho_subtiers.append(pho_subtier)
+        else:
+            [pho_subtier] = pho_subtiers
+            if pho_subtier.contents == contents:
+                return False
+            pho_subtier.contents = contents
+
+        self.extract_phonetic_transcriptions()
+        return True
+
     def __str__(self):
         if not self.parsed:
             main = ''.join(self.main_tier_lines_unparsed)
@@ -254,10 +385,25 @@ class MainTier(object):
 
 
 class CHAFile(object):
-    def __init__(self, path):
+    def __init__(self, path, data=None):
+        """
+        :param path: path to the cha file
+        :param data: contents of the file if they have already been read, e.g., by prefetch.PrefetchingReader. The file
+        at path is then never read.
+        """
         self.path = path
+        self.data = data
         self.partially_parsed = None
 
+    def _read(self):
+        """
+        Reads the file in the text mode (with universal newlines) from self.data if there is any, or from self.path
+        """
+        if self.data is not None:
+            return io.TextIOWrapper(io.BytesIO(self.data), encoding='utf-8').read()
+        with open(self.path, 'r', encoding='utf-8') as f:
+            return f.read()
+
     @property
     def main_tiers(self):
         return [object for object in self.partially_parsed if type(object) is MainTier]
@@ -274,8 +420,8 @@ class CHAFile(object):
 
         partially_parsed = list()
 
-        with open(self.path, 'r', encoding='utf-8') as f:
-            text = f.readlines()
+        # Not splitlines - it would also split on the characters other than '\n'
+        text = io.StringIO(self._read()).readlines()
 
         main_tier = MainTier()
         for i, line in enumerate(text):
@@ -297,33 +443,49 @@ class CHAFile(object):
     def process_for_phonetic_transcription(self, speaker_code):
         """
         Parses main tiers, extracts annotated words, categorizes subtiers, extracts transcriptions.
-        Skips the main tiers not mentioning the speaker code
+        Skips the main tiers not mentioning the speaker code. Can be called again after editing the tiers: only the
+        tiers that have changed since the last call are reprocessed, see MainTier.process_for_phonetic_transcription.
         :param speaker_code: CHI, MOT, etc.
-        :return: None
+        :return: int - number of the main tiers that were (re)processed
         """
         if not self.partially_parsed:
             self.partially_parse()
 
-        for mt in self.main_tiers:
-            # parse
-            if not mt.parsed:
-                mt.parse()
+        return sum(mt.process_for_phonetic_transcription(speaker_code) for mt in self.main_tiers)
 
-            # skip if the speaker code is not in the annotations
-            if not mt.is_speaker_in_annotation(speaker_code=speaker_code):
-                continue
+    def transcriptions_by_annotid(self, speaker_code):
+        """
+        Maps annotids of the words uttered by speaker_code to their transcriptions. Needs
+        process_for_phonetic_transcription to have been run for the speaker.
+        :param speaker_code: CHI, MOT, etc.
+        :return: dict, words without a transcription are mapped to None
+        """
+        transcriptions_by_annotid = dict()
+        for mt in self.main_tiers:
+            transcriptions = mt.transcriptions or []
+            for i, annotid in enumerate(mt.annotid_of_words_uttered_by.get(speaker_code, [])):
+                transcriptions_by_annotid[annotid] = transcriptions[i] if i < len(transcriptions) else None
+        return transcriptions_by_annotid
 
-            # extract annotated words
-            if speaker_code not in mt.words_uttered_by:
-                mt.extract_words_by_speaker(speaker_code)
+    def tier_times(self):
+        """
+        Start and end times of the main tiers that have timestamps, parses the main tiers if they haven't been parsed.
+        :return: dataframe with TIER_TIMES_COLUMNS sorted by time_start, the times are int64 milliseconds and
+        tier_index is the position in self.main_tiers. Use time_index.TimeIndex.from_frame(..., 'tier_index') to query
+        it by time.
+        """
+        if not self.partially_parsed:
+            self.partially_parse()
 
-            # categorize subtiers based on their labels
-            if not mt.sub_tiers_by_label:
-                mt.categorize_subtiers()
+        rows = list()
+        for tier_index, mt in enumerate(self.main_tiers):
+            if not mt.parsed:
+                mt.parse()
+            if mt.time_start is not None:
+                rows.append((tier_index, mt.time_start, mt.time_end))
 
-            # Extract transcriptions
-            if not mt.transcriptions:
-                mt.extract_phonetic_transcriptions()
+        tier_times = pd.DataFrame(np.array(rows, dtype='int64').reshape(-1, 3), columns=TIER_TIMES_COLUMNS)
+        return tier_times.sort_values('time_start', kind='stable', ignore_index=True)
 
     @property
     def compiled(self):
@@ -347,7 +509,7 @@ class CHAFile(object):
         Compares current state to the original text
         :return: bool
         """
-        return open(self.path, 'r').read() == self.compiled
+        return self._read() == self.compiled
 
     def write(self, path=None, overwrite_original=False):
         if not path and not overwrite_original:
@@ -0,0 +1,106 @@
+"""
+Finds the speakers of cha files from their headers alone.
+
+Only the lines before the first main tier are read: the @Participants line lists the speaker codes with their roles
+and each @ID line has the code in its third field. The results are saved to a json index keyed by the file path and
+re-read only for the files that changed since, so that the drivers can skip the files that can't have a given speaker
+without opening them.
+"""
+import json
+from pathlib import Path
+
+
+PARTICIPANTS_LABEL = '@Participants:'
+ID_LABEL = '@ID:'
+
+
+def read_header_lines(path: Path):
+    """
+    Reads the lines before the first main tier. Lines continued on the next line (the next line starts with a tab)
+    are joined.
+    :return: list of str without the line endings
+    """
+    header_lines = list()
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.startswith('*'):
+                break
+            line = line.rstrip('\n')
+            if line.startswith('\t') and header_lines:
+                header_lines[-1] += ' ' + line.strip()
+            else:
+                header_lines.append(line)
+    return header_lines
+
+
+def speakers_in_header(header_lines):
+    """
+    :param header_lines: output of read_header_lines
+    :return: set of the speaker codes from the @Participants and @ID lines
+    """
+    speakers = set()
+    for line in header_lines:
+        label, _, contents = line.partition('\t')
+        if label == PARTICIPANTS_LABEL:
+            # CHI Target_Child, MOT Mother, ...
+            speakers.update(participant.split()[0] for participant in contents.split(',') if participant.strip())
+        elif label == ID_LABEL:
+            # language|corpus|code|age|sex|group|SES|role|education|custom|
+            fields = contents.split('|')
+            if len(fields) > 2 and fields[2].strip():
+                speakers.add(fields[2].strip())
+    return speakers
+
+
+class ParticipantIndex(object):
+    """
+    Persistent index of the speakers of each cha file. A file is re-scanned if its size or mtime changed since it was
+    indexed.
+    """
+    def __init__(self, index_path: Path):
+        self.index_path = Path(index_path)
+        self.entries = dict()
+        if self.index_path.exists():
+            with self.index_path.open('r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+        self._changed = False
+
+    @staticmethod
+    def _key(path: Path):
+        return str(Path(path).absolute())
+
+    def speakers_of(self, path: Path):
+        """
+        :return: set of the speaker codes in the header of the file, empty if the header has neither @Participants nor
+        @ID lines
+        """
+        stat = Path(path).stat()
+        key = self._key(path)
+        entry = self.entries.get(key)
+        if entry is None or (entry['mtime_ns'], entry['size']) != (stat.st_mtime_ns, stat.st_size):
+            entry = dict(mtime_ns=stat.st_mtime_ns, size=stat.st_size,
+                         speakers=sorted(speakers_in_header(read_header_lines(path))))
+            self.entries[key] = entry
+            self._changed = True
+        return set(entry['speakers'])
+
+    def might_contain(self, path: Path, speaker_code):
+        """
+        Files without any speakers in the header are never ruled out.
+        """
+        speakers = self.speakers_of(path)
+        return not speakers or speaker_code in speakers
+
+    def filter_paths(self, paths, speaker_code):
+        """
+        :return: the paths of the files that might contain speaker_code, in the original order
+        """
+        return [path for path in paths if self.might_contain(path, speaker_code)]
+
+    def save(self):
+        if not self._changed:
+            return
+        self.index_path.parent.mkdir(parents=True, exist_ok=True)
+        with self.index_path.open('w', encoding='utf-8') as f:
+            json.dump(self.entries, f, indent=1)
+        self._changed = False
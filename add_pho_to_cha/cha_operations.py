@@ -0,0 +1,88 @@
+"""
+Operations on the cha files recorded in operation_log.OperationLog and the function that applies them.
+
+Main tiers are identified by the annotid of any of the words annotated in them, so the operations can be applied to a
+file that has already been changed by some of them, e.g., to the backup copy after the original file has been updated,
+or twice in a row.
+
+    cha.set_pho_subtier(speaker, annotid, contents) - sets the contents of the %pho: subtier (adds it if necessary)
+    cha.set_pho(speaker, annotid, transcription) - sets the transcription of a single word
+"""
+from cha import CHAFile, TRANSCRIPTION_LABEL
+
+
+SET_PHO_SUBTIER = 'cha.set_pho_subtier'
+SET_PHO = 'cha.set_pho'
+
+# Results of MainTier.update_pho after which the pho subtier is different
+PHO_CHANGING_STATUSES = ('pho subtier added', "###'s added, needs transcription", "###'s removed, needs transcription")
+
+
+def record_pho_update(log, path, main_tier, speaker_code):
+    """
+    Records the change MainTier.update_pho has made to the pho subtier, if any.
+    :param log: OperationLog object
+    :param path: path to the cha file
+    :param main_tier: MainTier object update_pho has just been run for
+    :param speaker_code: the speaker update_pho has been run for
+    """
+    if main_tier.pho_status not in PHO_CHANGING_STATUSES:
+        return
+    [pho_subtier] = main_tier.sub_tiers_by_label[TRANSCRIPTION_LABEL]
+    log.append(SET_PHO_SUBTIER, path, speaker=speaker_code,
+               annotid=main_tier.annotid_of_words_uttered_by[speaker_code][0], contents=pho_subtier.contents)
+
+
+def record_set_pho(log, path, speaker_code, annotid, transcription):
+    log.append(SET_PHO, path, speaker=speaker_code, annotid=annotid, transcription=transcription)
+
+
+def _locate_words(cha_file, speaker_code):
+    """
+    :return: dict annotid -> (MainTier object, index of the word among the words uttered by the speaker in that tier)
+    """
+    locations = dict()
+    for mt in cha_file.main_tiers:
+        for i, annotid in enumerate(mt.annotid_of_words_uttered_by.get(speaker_code, [])):
+            locations[annotid] = (mt, i)
+    return locations
+
+
+def apply_operations(path, operations):
+    """
+    Applies the operations to a cha file and overwrites it if anything changed.
+    :param path: path to the cha file
+    :param operations: list of operation_log.Operation objects
+    :return: bool - whether the file has changed
+    """
+    cha_file = CHAFile(path)
+    locations = dict()
+    for speaker_code in dict.fromkeys(operation.arguments['speaker'] for operation in operations):
+        cha_file.process_for_phonetic_transcription(speaker_code)
+        locations[speaker_code] = _locate_words(cha_file, speaker_code)
+
+    for operation in operations:
+        arguments = operation.arguments
+        location = locations[arguments['speaker']].get(arguments['annotid'])
+        if location is None:
+            raise KeyError(f'No word with annotid {arguments["annotid"]} in {path}')
+        mt, word_index = location
+
+        if operation.name == SET_PHO_SUBTIER:
+            mt.set_pho_contents(arguments['contents'])
+        elif operation.name == SET_PHO:
+            transcriptions = list(mt.transcriptions or [])
+            if len(transcriptions) != len(mt.words_uttered_by[arguments['speaker']]):
+                raise ValueError(f'The number of transcriptions and words differ in the tier with annotid '
+                                 f'{arguments["annotid"]} in {path}')
+            transcriptions[word_index] = arguments['transcription']
+            mt.set_pho_contents(' '.join(transcriptions) + '\n')
+        else:
+            raise ValueError(f'Unknown operation: {operation.name}')
+
+    # Later operations can undo the earlier ones, e.g., when the whole log is replayed again, so we compare the end
+    # result to the file instead of counting the operations that changed something
+    if cha_file.no_changes():
+        return False
+    cha_file.write(overwrite_original=True)
+    return True
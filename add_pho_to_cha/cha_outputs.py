@@ -0,0 +1,100 @@
+"""
+Per-file parts of the outputs of update_pho_in_cha.py, shared by the full run, the watch mode, and the batch mode.
+"""
+from pathlib import Path
+from collections import namedtuple
+
+from cha import CHAFile
+from cha_operations import record_pho_update
+from pho_validation import find_pho_errors
+from operation_log import OperationLog
+
+
+STATUS_COLUMNS = ('file_path', 'tier_index', 'status')
+TO_TRANSCRIBE_COLUMNS = ('file_path', 'word', 'annotid', 'transcription')
+
+# Main tiers with a missing annotid, update_pho is not run for these
+FIRST_LINES_TO_SKIP = (
+    'penguin &=n_y_CHI_0x352e93 penguin &=n_y_CHI_0x366d19 penguin\n',
+    'oranges &=d_y_MOT_0x1d8f75 apples &=d_n_MOT_0x4945d6 oranges\n',
+    'apple &=n_y_CHI_0x5f42b9 apple &=n_y_CHI_0xb1a1bb apple &=n_y_CHI\n')
+
+
+def load_cha_file(path: Path, speaker_code, data=None):
+    cha_file = CHAFile(path, data=data)
+    cha_file.process_for_phonetic_transcription(speaker_code)
+    return cha_file
+
+
+def update_pho_in_file(cha_file, speaker_code):
+    """
+    Runs MainTier.update_pho for all the main tiers but the ones in FIRST_LINES_TO_SKIP.
+    :return: list of (main tier index, MainTier object, status)
+    """
+    results = list()
+    for tier_index, mt in enumerate(cha_file.main_tiers):
+        if mt.contents[0] in FIRST_LINES_TO_SKIP:
+            continue
+        results.append((tier_index, mt, mt.update_pho(speaker_code)))
+    return results
+
+
+def status_rows(cha_file, update_pho_results):
+    """
+    :param update_pho_results: output of update_pho_in_file
+    :return: rows with STATUS_COLUMNS
+    """
+    return [(cha_file.path.absolute(), tier_index, status) for tier_index, _, status in update_pho_results]
+
+
+def to_transcribe_rows(cha_file, speaker_code):
+    """
+    :return: rows with TO_TRANSCRIBE_COLUMNS for the words that have not been transcribed yet
+    """
+    rows = list()
+    for mt in cha_file.main_tiers:
+        if speaker_code in mt.words_uttered_by:
+            for word, annotid, transcription in zip(mt.words_uttered_by[speaker_code],
+                                                    mt.annotid_of_words_uttered_by[speaker_code],
+                                                    mt.transcriptions):
+                if transcription == '###':
+                    rows.append((cha_file.path.absolute(),
+                                 word,
+                                 annotid,
+                                 transcription))
+    return rows
+
+
+# What process_cha_file returns, all the rows of one file
+CHAFileResult = namedtuple('CHAFileResult', ['statuses', 'to_transcribe', 'pho_errors', 'operations'])
+
+
+def process_cha_file(path: Path, speaker_code, data=None):
+    """
+    Runs all the steps and checks of update_pho_in_cha.py for a single file, for the batch mode.
+    :return: CHAFileResult
+    :raise ValueError: if any of the checks fail
+    """
+    cha_file = load_cha_file(path, speaker_code, data=data)
+
+    tier_errors = [error for mt in cha_file.main_tiers if mt.contents[0] not in FIRST_LINES_TO_SKIP
+                   for error in mt.errors]
+    if tier_errors:
+        raise ValueError(f'{len(tier_errors)} parsing errors, the first one: {tier_errors[0]}')
+    if not cha_file.no_changes():
+        raise ValueError('The file can\'t be reconstructed without changes')
+
+    update_pho_results = update_pho_in_file(cha_file, speaker_code)
+    operation_log = OperationLog()
+    for _, mt, _ in update_pho_results:
+        record_pho_update(operation_log, cha_file.path, mt, speaker_code)
+    update_pho_errors = [status for _, _, status in update_pho_results if status.startswith('error')]
+    if update_pho_errors:
+        raise ValueError(f'update_pho errors: {sorted(set(update_pho_errors))}')
+    if not cha_file.no_changes():
+        raise ValueError(f'update_pho has made {len(operation_log)} changes that haven\'t been written to the file yet')
+
+    return CHAFileResult(statuses=status_rows(cha_file, update_pho_results),
+                         to_transcribe=to_transcribe_rows(cha_file, speaker_code),
+                         pho_errors=list(find_pho_errors([cha_file]).itertuples(index=False, name=None)),
+                         operations=list(operation_log))
@@ -4,6 +4,8 @@ annotations = fr'(?P<annotations>(?:{annotation} +)*)'
 
 lena_annotation = r'(?:0|&=(?:w\d+(?:_\d+)?|vocalization|crying|vfx))'
 timestamp = r'\x15\d+_\d+\x15'
+# Same, with the start and the end in milliseconds captured
+timestamp_times = r'\x15(?P<start>\d+)_(?P<end>\d+)\x15'
 maybe_zero = r'(?:0 +)?'
 maybe_dot = r'(?:\. +)?'
 maybe_zero_and_a_dot = r'(?:0\. +)?'
@@ -13,4 +15,5 @@ main_tier_content_pattern = fr'{annotations}{other}$'
 # used to identify main tier lines manually split over multiple lines
 ends_with_a_timestamp = fr'^.*{timestamp}$'
 
-transcription_pattern = r"^[a-zA-Z?&'36:.+`@^]+$"
+transcription_character = r"[a-zA-Z?&'36:.+`@^]"
+transcription_pattern = fr"^{transcription_character}+$"
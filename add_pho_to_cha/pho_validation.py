@@ -0,0 +1,67 @@
+"""
+Validates all the %pho: transcriptions of a run at once.
+
+The tokens of all the pho subtiers are collected into a single series and classified in one vectorized pass, with the
+same rules MainTier.extract_phonetic_transcriptions uses: ipa, not transcribed (###), or error. The errors are returned
+as a table with one row per offending token that can be saved, filtered, and grouped like any other dataframe.
+"""
+from pathlib import Path
+
+import pandas as pd
+
+from cha import TRANSCRIPTION_LABEL
+from cha_re import transcription_pattern, transcription_character
+
+
+TOKEN_COLUMNS = ['file_path', 'tier_index', 'position', 'token']
+ERROR_COLUMNS = TOKEN_COLUMNS + ['offending_characters']
+
+
+def collect_pho_tokens(cha_files):
+    """
+    Collects the tokens of the pho subtiers of all the parsed main tiers.
+    :param cha_files: CHAFile objects, parsed with process_for_phonetic_transcription
+    :return: dataframe with TOKEN_COLUMNS. tier_index is the ordinal of the main tier in its file, position - the
+    ordinal of the token in its pho subtier.
+    """
+    file_paths, tier_indices, positions, tokens = list(), list(), list(), list()
+    for cha_file in cha_files:
+        for tier_index, mt in enumerate(cha_file.main_tiers):
+            if not mt.parsed:
+                continue
+            for sub_tier in mt.sub_tiers:
+                if sub_tier.label != TRANSCRIPTION_LABEL:
+                    continue
+                subtier_tokens = sub_tier.contents.split()
+                file_paths.extend([Path(cha_file.path).absolute()] * len(subtier_tokens))
+                tier_indices.extend([tier_index] * len(subtier_tokens))
+                positions.extend(range(len(subtier_tokens)))
+                tokens.extend(subtier_tokens)
+
+    return pd.DataFrame({'file_path': file_paths, 'tier_index': tier_indices, 'position': positions,
+                         'token': pd.Series(tokens, dtype=object)})
+
+
+def classify_pho_tokens(tokens: pd.Series):
+    """
+    :param tokens: series of str
+    :return: series of 'ipa', 'not transcribed', and 'error' aligned with tokens
+    """
+    kinds = pd.Series('error', index=tokens.index, dtype=object)
+    kinds[tokens.str.match(transcription_pattern).astype(bool)] = 'ipa'
+    kinds[tokens == '###'] = 'not transcribed'
+    return kinds
+
+
+def find_pho_errors(cha_files):
+    """
+    :param cha_files: CHAFile objects, parsed with process_for_phonetic_transcription
+    :return: dataframe with ERROR_COLUMNS, one row per token that is neither a transcription nor ###
+    """
+    tokens = collect_pho_tokens(cha_files)
+    errors = tokens[classify_pho_tokens(tokens.token) == 'error'].reset_index(drop=True)
+    # Each character not allowed in a transcription, once, in the order of appearance
+    errors['offending_characters'] = (errors.token
+                                      .str.replace(transcription_character, '', regex=True)
+                                      .map(lambda characters: ''.join(dict.fromkeys(characters))))
+    return errors.reindex(columns=ERROR_COLUMNS)
@@ -1,42 +1,133 @@
 from pathlib import Path
 from collections import defaultdict
 
-from add_pho_to_cha.cha import CHAFile
+import pandas as pd
+
+from add_pho_to_cha.cha_outputs import load_cha_file, update_pho_in_file, status_rows, to_transcribe_rows, \
+    STATUS_COLUMNS, TO_TRANSCRIBE_COLUMNS, FIRST_LINES_TO_SKIP, process_cha_file
+from add_pho_to_cha import cha_operations
+from add_pho_to_cha.pho_validation import find_pho_errors, ERROR_COLUMNS as PHO_ERROR_COLUMNS
+from add_pho_to_cha.cha_headers import ParticipantIndex
+from operation_log import OperationLog
+from prefetch import PrefetchingReader
+import shards
+from corpus_index import CorpusIndex
+from watch import watch, write_table
+from checkpoint import Checkpoint, run_batch, write_error_report
 
 SPEAKER_CODE = 'CHI'
 
+TO_TRANSCRIBE_FILENAME = 'to_transcribe.csv'
+STATUS_FILENAME = 'update_pho_status.csv'
+OPERATION_LOG_FILENAME = 'cha_operations.jsonl'
+PHO_ERRORS_FILENAME = 'pho_errors.csv'
+ERROR_REPORT_FILENAME = 'failed_files.csv'
+
 
 # In[]:
-# # Find all the chas
-seedlings_path = Path('/Volumes/pn-opus/Seedlings')
-assert seedlings_path.exists()
+# # Sharding
+# To split the work between machines, run with --shard i/N (or --paths <file>) and --output-dir <shard dir>, then merge
+# the outputs with --merge <shard dir 0> ... <shard dir N-1> --output-dir <dir>. See shards.py.
+def add_arguments(parser):
+    parser.add_argument('--index', type=Path, help='SQLite index to update with the results, see corpus_index.py')
+    parser.add_argument('--participant-index', type=Path,
+                        help='Skip the files whose headers don\'t list the speaker, using and updating this index of '
+                             'the speakers of each file, see cha_headers.py')
+    parser.add_argument('--watch', action='store_true',
+                        help='After the run, keep reprocessing the files that change and updating the csv outputs')
+    parser.add_argument('--batch', type=Path, metavar='CHECKPOINT_DIR',
+                        help='Process the files one by one, list the ones that fail any of the checks instead of '
+                             'stopping, and save the progress to this folder to resume from. Doesn\'t change any '
+                             'files.')
+
+
+args = shards.parse_args(description='Add/update pho subtiers in the cha files, list the words to transcribe.',
+                         add_arguments=add_arguments)
+output_dir = args.output_dir or Path('.')
+
+if args.merge:
+    for filename in (TO_TRANSCRIBE_FILENAME, STATUS_FILENAME, PHO_ERRORS_FILENAME, ERROR_REPORT_FILENAME):
+        n_rows = shards.merge_csvs(args.merge, filename, output_dir / filename)
+        print(f'{n_rows} rows merged into {output_dir / filename}')
+    shard_logs = [shard_dir / OPERATION_LOG_FILENAME for shard_dir in args.merge
+                  if (shard_dir / OPERATION_LOG_FILENAME).exists()]
+    if shard_logs:
+        merged_log = OperationLog()
+        for shard_log in shard_logs:
+            merged_log.extend(OperationLog.load(shard_log))
+        merged_log.save(output_dir / OPERATION_LOG_FILENAME)
+    raise SystemExit
+
 
-cha_file_path_list = seedlings_path.joinpath('Scripts_and_Apps/Github/seedlings/path_files/cha_sparse_code_paths.txt')
+# In[]:
+# # Find all the chas
+if args.path_list:
+    cha_file_path_list = args.path_list
+else:
+    seedlings_path = Path('/Volumes/pn-opus/Seedlings')
+    assert seedlings_path.exists()
+
+    cha_file_path_list = seedlings_path.joinpath(
+        'Scripts_and_Apps/Github/seedlings/path_files/cha_sparse_code_paths.txt')
 assert cha_file_path_list.exists()
 
 with cha_file_path_list.open('r', encoding='utf-8') as f:
     cha_paths = list(map(lambda line: Path(line.rstrip()), f))
 
+cha_paths = shards.paths_to_process(args, cha_paths)
+
+# Only the headers are read to rule out the files without the speaker, most of them are already in the index
+if args.participant_index:
+    participant_index = ParticipantIndex(args.participant_index)
+    n_paths = len(cha_paths)
+    cha_paths = participant_index.filter_paths(cha_paths, SPEAKER_CODE)
+    participant_index.save()
+    print(f'{n_paths - len(cha_paths)} files without {SPEAKER_CODE} in the header skipped')
+
 
 # In[]:
-# # Load an parse
+# # Batch mode
+# Same checks as below, but a file that fails one of them is listed in the error report instead of stopping everything.
+# The files that passed are recorded in the checkpoint folder and are not processed again unless they change.
+if args.batch:
+    results, failures = run_batch(cha_paths, lambda path, data: process_cha_file(path, SPEAKER_CODE, data=data),
+                                  Checkpoint(args.batch))
+    write_error_report(failures, output_dir / ERROR_REPORT_FILENAME)
+
+    for filename, columns, rows in (
+            (STATUS_FILENAME, STATUS_COLUMNS, [row for result in results.values() for row in result.statuses]),
+            (TO_TRANSCRIBE_FILENAME, TO_TRANSCRIBE_COLUMNS,
+             [row for result in results.values() for row in result.to_transcribe]),
+            (PHO_ERRORS_FILENAME, PHO_ERROR_COLUMNS,
+             [row for result in results.values() for row in result.pho_errors])):
+        pd.DataFrame(columns=columns, data=rows).to_csv(output_dir / filename, index=False)
+    print(f'{len(results)} files processed without errors, outputs written to {output_dir.absolute()}')
+    raise SystemExit
 
-cha_files = [CHAFile(cha_path) for cha_path in cha_paths]
 
-for i, cha_file in enumerate(cha_files):
+# In[]:
+# # Load an parse
+
+# The files are read from the network share concurrently, ahead of the one being parsed
+cha_files = list()
+for i, (cha_path, data) in enumerate(PrefetchingReader(cha_paths)):
     end = '\n' if i % 20 == 19 else ' '
     print(f'{i:03}', end=end)
-    
-    cha_file.process_for_phonetic_transcription(SPEAKER_CODE)
 
+    cha_files.append(load_cha_file(cha_path, SPEAKER_CODE, data=data))
 
-# Check for parsing errors
-first_lines_to_skip = (
-    'penguin &=n_y_CHI_0x352e93 penguin &=n_y_CHI_0x366d19 penguin\n',
-    'oranges &=d_y_MOT_0x1d8f75 apples &=d_n_MOT_0x4945d6 oranges\n',
-    'apple &=n_y_CHI_0x5f42b9 apple &=n_y_CHI_0xb1a1bb apple &=n_y_CHI\n')
 
-assert not any(mt.errors and mt.contents[0] not in first_lines_to_skip for cf in cha_files for mt in cf.main_tiers)
+# Check the transcriptions, all the pho tokens at once. Done before the check below so that the table of the invalid
+# ones is written even if it fails.
+pho_errors = find_pho_errors(cha_files)
+pho_errors_path = output_dir / PHO_ERRORS_FILENAME
+pho_errors_path.parent.mkdir(parents=True, exist_ok=True)
+pho_errors.to_csv(pho_errors_path, index=False)
+if len(pho_errors) > 0:
+    print(f'{len(pho_errors)} invalid transcriptions written to {pho_errors_path.absolute()}')
+
+# Check for parsing errors
+assert not any(mt.errors and mt.contents[0] not in FIRST_LINES_TO_SKIP for cf in cha_files for mt in cf.main_tiers)
 
 # In[]
 # # Check that the files can be reconstructed without changes before introducing any
@@ -47,12 +138,22 @@ for cf in cha_files:
 # In[]
 # # Add pho tier or '###' and check for transcription errors (too few, too many, etc.)
 main_tiers = defaultdict(list)
+statuses = list()
+# The changes are also recorded so that they can be replayed onto the original files and their backups
+operation_log = OperationLog()
 for cf in cha_files:
-    for mt in cf.main_tiers:
-        # Skip main tiers with a missing annotid
-        if mt.contents[0] in first_lines_to_skip:
-            continue
-        main_tiers[mt.update_pho(SPEAKER_CODE)].append((cf, mt))
+    # Main tiers with a missing annotid are skipped
+    update_pho_results = update_pho_in_file(cf, SPEAKER_CODE)
+    for tier_index, mt, status in update_pho_results:
+        main_tiers[status].append((cf, mt))
+        cha_operations.record_pho_update(operation_log, cf.path, mt, SPEAKER_CODE)
+    statuses.extend(status_rows(cf, update_pho_results))
+
+status_path = output_dir / STATUS_FILENAME
+status_path.parent.mkdir(parents=True, exist_ok=True)
+pd.DataFrame(columns=STATUS_COLUMNS, data=statuses).to_csv(status_path, index=False)
+if len(operation_log) > 0:
+    operation_log.save(output_dir / OPERATION_LOG_FILENAME)
 
 assert not any(status.startswith('error') for status in main_tiers)
 
@@ -64,31 +165,66 @@ for cf in cha_files:
 
 # In[]
 # # Write the results
-# for cf in cha_files:
-#     cf.write(overwrite_original=True)
+# Replay the operation log onto the backups first, check them, then onto the originals. Only the files with changes are
+# rewritten and replaying the log again does nothing. The log can also be loaded with OperationLog.load.
+# from operation_log import replay
+# replay(operation_log, {'cha': cha_operations.apply_operations}, target_for=lambda path: <backup path>)
+# replay(operation_log, {'cha': cha_operations.apply_operations})
 
 
 # In[]
 # # Output a list of words that need transcription
 to_transcribe = list()
 for cf in cha_files:
-    for mt in cf.main_tiers:
-        if SPEAKER_CODE in mt.words_uttered_by:
-            for word, annotid, transcription in zip(mt.words_uttered_by[SPEAKER_CODE],
-                                                    mt.annotid_of_words_uttered_by[SPEAKER_CODE],
-                                                    mt.transcriptions):
-                if transcription == '###':
-                    to_transcribe.append((cf.path.absolute(),
-                                          word,
-                                          annotid,
-                                          transcription))
+    to_transcribe.extend(to_transcribe_rows(cf, SPEAKER_CODE))
 
 if to_transcribe:
-    to_transcribe_path = Path('to_transcribe.csv')
+    to_transcribe_path = output_dir / TO_TRANSCRIBE_FILENAME
     to_transcribe_path.parent.mkdir(parents=True, exist_ok=True)
-    import pandas as pd
     to_transribe_df = pd.DataFrame(
-        columns=('file_path', 'word', 'annotid', 'transcription'),
+        columns=TO_TRANSCRIBE_COLUMNS,
         data=to_transcribe)
-    to_transribe_df.to_csv('to_transcribe.csv', index=False)
+    to_transribe_df.to_csv(to_transcribe_path, index=False)
     print(f"Words that require transcribing written to {to_transcribe_path.absolute()}")
+
+
+# In[]
+# # Update the query index - only the files that changed since they were last indexed
+if args.index:
+    with CorpusIndex(args.index) as index:
+        for cf in cha_files:
+            if not index.is_up_to_date(cf.path):
+                index.index_cha_file(cf, SPEAKER_CODE)
+
+
+# In[]
+# # Watch mode
+# Keeps the csv outputs up to date while the files are being edited. Only the changed files are parsed again, the rows
+# of the other ones are reused.
+if args.watch:
+    # Rows of each file, by the absolute path the rows have in the file_path column
+    statuses_by_path, to_transcribe_by_path = defaultdict(list), defaultdict(list)
+    for rows, rows_by_path in ((statuses, statuses_by_path), (to_transcribe, to_transcribe_by_path)):
+        for row in rows:
+            rows_by_path[row[0]].append(row)
+
+    def reprocess(changed_paths):
+        for path in changed_paths:
+            if not path.exists():
+                statuses_by_path.pop(path.absolute(), None)
+                to_transcribe_by_path.pop(path.absolute(), None)
+                continue
+            try:
+                cha_file = load_cha_file(path, SPEAKER_CODE)
+                statuses_by_path[path.absolute()] = status_rows(cha_file, update_pho_in_file(cha_file, SPEAKER_CODE))
+                to_transcribe_by_path[path.absolute()] = to_transcribe_rows(cha_file, SPEAKER_CODE)
+            except Exception as e:
+                # Probably saved in the middle of an edit, the previous rows are kept until the next save
+                print(f'Could not process {path}: {e!r}')
+
+        for rows_by_path, columns, filename in ((statuses_by_path, STATUS_COLUMNS, STATUS_FILENAME),
+                                                (to_transcribe_by_path, TO_TRANSCRIBE_COLUMNS, TO_TRANSCRIBE_FILENAME)):
+            rows = [row for path in cha_paths for row in rows_by_path.get(path.absolute(), [])]
+            write_table(pd.DataFrame(columns=columns, data=rows), output_dir / filename)
+
+    watch(cha_paths, reprocess)
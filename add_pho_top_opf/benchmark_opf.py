@@ -0,0 +1,120 @@
+"""
+Benchmarks the OPF pipeline stages on synthetic opf files.
+
+Example:
+    python benchmark_opf.py --cells 1000 10000 100000 --save-baseline
+    python benchmark_opf.py --cells 1000 10000 100000
+
+Each stage is timed and its peak memory measured with tracemalloc. The results are compared to the baseline file if
+it exists.
+"""
+import json
+import argparse
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+from opf import OPFFile, OPFDataFrame, FAST_COMPRESSLEVEL
+from opf_reports import collect_all_chi
+from synthetic_opf import write_synthetic_opf
+
+
+DEFAULT_BASELINE_PATH = Path(__file__).parent / 'benchmarks' / 'baseline.json'
+
+
+def measure(function, repeat, setup=None):
+    """
+    Runs function repeat times.
+    :param setup: optional function called before each run, outside of the measurement. Its result is passed to
+    function, e.g., a fresh object for each run so that nothing cached by the previous run is reused.
+    :return: (result of the last call, best wall time in seconds, peak memory in bytes over all runs)
+    """
+    best_time, peak = float('inf'), 0
+    result = None
+    for _ in range(repeat):
+        # Drop the result of the previous run before measuring
+        result = None
+        args = (setup(),) if setup else ()
+        tracemalloc.start()
+        start = time.perf_counter()
+        result = function(*args)
+        best_time = min(best_time, time.perf_counter() - start)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return result, best_time, peak
+
+
+def _modified_df(opf_file):
+    opf_df = OPFDataFrame(opf_file)
+    opf_df.mark_modified()
+    return opf_df
+
+
+def run_benchmarks(cell_counts, repeat=3, work_dir: Path = None):
+    """
+    :return: dict with "<stage>@<cells>" keys and dict(cells_per_sec, seconds, peak_mb) values
+    """
+    results = dict()
+    with tempfile.TemporaryDirectory(dir=work_dir) as tmp_dir:
+        tmp_dir = Path(tmp_dir)
+        for n_cells in cell_counts:
+            opf_path = write_synthetic_opf(tmp_dir / f'synthetic_{n_cells}.opf', n_cells=n_cells, extra_bytes=100_000)
+            output_path = tmp_dir / f'output_{n_cells}.opf'
+
+            opf_file, *stats = measure(lambda: OPFFile(opf_path), repeat)
+            stage_stats = dict(load=stats)
+            opf_df, *stage_stats['parse'] = measure(lambda: OPFDataFrame(opf_file), repeat)
+            # OPFDataFrame keeps the serialized cells, so each run gets a new one. Unmodified ones return the original
+            # db, marking them modified makes them serialize all the cells.
+            _, *stage_stats['str'] = measure(str, repeat, setup=lambda: _modified_df(opf_file))
+            _, *stage_stats['collect_all_chi'] = measure(lambda: collect_all_chi(opf_df), repeat)
+            _, *stage_stats['write'] = measure(lambda: opf_file._write_to_opf(output_path), repeat)
+            _, *stage_stats['write_fast'] = measure(
+                lambda: opf_file._write_to_opf(output_path, compresslevel=FAST_COMPRESSLEVEL), repeat)
+
+            for stage, (seconds, peak) in stage_stats.items():
+                results[f'{stage}@{n_cells}'] = dict(cells_per_sec=n_cells / seconds,
+                                                     seconds=seconds,
+                                                     peak_mb=peak / 2 ** 20)
+    return results
+
+
+def print_results(results, baseline=None):
+    baseline = baseline or dict()
+    print(f'{"stage":<28}{"cells/sec":>14}{"peak MB":>10}{"speed vs baseline":>20}{"memory vs baseline":>20}')
+    for key, result in results.items():
+        line = f'{key:<28}{result["cells_per_sec"]:>14,.0f}{result["peak_mb"]:>10.1f}'
+        if key in baseline:
+            speed = result['cells_per_sec'] / baseline[key]['cells_per_sec']
+            memory = result['peak_mb'] / baseline[key]['peak_mb'] if baseline[key]['peak_mb'] else float('nan')
+            line += f'{speed:>19.2f}x{memory:>19.2f}x'
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the OPF pipeline on synthetic files.')
+    parser.add_argument('--cells', type=int, nargs='+', default=[1_000, 10_000, 100_000],
+                        help='Number of cells in the synthetic files')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of runs per stage, the best time is reported')
+    parser.add_argument('--baseline', type=Path, default=DEFAULT_BASELINE_PATH, help='Baseline json file')
+    parser.add_argument('--save-baseline', action='store_true', help='Save the results as the new baseline')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.cells, repeat=args.repeat)
+
+    baseline = None
+    if args.baseline.exists():
+        with args.baseline.open('r', encoding='utf-8') as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+
+    if args.save_baseline:
+        args.baseline.parent.mkdir(parents=True, exist_ok=True)
+        with args.baseline.open('w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        print(f'Baseline saved to {args.baseline}')
+
+
+if __name__ == '__main__':
+    main()
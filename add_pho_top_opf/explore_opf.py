@@ -1,220 +1,212 @@
-import os
+import sys
+import atexit
 from pathlib import Path
 
-import pandas as pd
-
-from opf import OPFFile, OPFDataFrame, DATETIME_FORMAT
-
-
-PHO_PREFIX = r'^%pho:?(?:&|\s+)'
+# The modules shared with the cha scripts (prefetch.py, shards.py, etc.) are at the root of the repo
+_repo_path = str(Path(__file__).resolve().parent.parent)
+if _repo_path not in sys.path:
+    sys.path.append(_repo_path)
 
+import pandas as pd
 
-def collect_all_chi(opf: OPFDataFrame):
+from opf import OPFFile, OPFDataFrame
+from prefetch import PrefetchingReader
+from opf_cache import OPFCache
+from opf_corpus import OPFCorpus
+from opf_sync import sync_to_backup, backup_path_for
+from opf_operations import record_add_field, apply_operations
+from operation_log import OperationLog, replay
+from opf_reports import collect_all_chi, build_reports, combine_reports, write_reports
+import shards
+from corpus_index import CorpusIndex
+from watch import watch
+from checkpoint import Checkpoint, run_batch, write_error_report
+import opf_profiling
+
+
+# Partial results of a shard, the reports are built from their concatenation when merging
+MATCHED_TABLE_FILENAME = 'all_chis_with_phos.pkl'
+# Changes made to the opf files, see operation_log.py
+OPERATION_LOG_FILENAME = 'opf_operations.jsonl'
+OPF_APPLIERS = {'opf': apply_operations}
+ERROR_REPORT_FILENAME = 'failed_files.csv'
+
+
+def concat_chis(chis_by_path):
     """
-    Finds all CHI and %pho cells and establishes their correspondence.
-    :param opf: OPFDataFrame object
-    :return: opf.df with only the CHI rows and with additional columns corresponding to the pho cell.
+    :param chis_by_path: dict opf path -> output of collect_all_chi
+    :return: one dataframe with the file_path column
     """
-    df: pd.DataFrame = opf.df.copy()
-
-    # For the fuzzy merging (time_end of CHI and %pho being approximately equal), we will need time_end to be a numeric
-    # (datetime in this case) column and sorted.
-    df['time_end'] = pd.to_datetime(df.time_end, format=DATETIME_FORMAT)
-    df.sort_values(by='time_end', inplace=True)
-
-    # Find child utterance and pho cells
-    is_chi = df.speaker == 'CHI'
-    is_pho = df.object.str.contains(PHO_PREFIX)
-
-    # We will only need some columns from the pho cells: time_start, time_end, annotid and object. The other ones should
-    # be empty ('NA' for original columns, '' for the 'pho' column). The exception is that sometimes the speaker field
-    # value is 'NA\, NEW' or 'NEW' - we can disregard this information.
-    columns_to_keep = ['object', 'id', 'time_start', 'time_end']
-    assert df[is_pho].drop(columns_to_keep, axis='columns').isin(['NA', '', 'NA\\, NEW', 'NEW']).all().all()
-
-    # # Merge
-    chis_with_phos = pd.merge_asof(
-        df[is_chi],
-        # rename time_end to keep both times for approximate matches
-        df[is_pho][columns_to_keep].rename(columns={'time_end': 'time_end_pho'}),
-        left_on='time_end',
-        right_on='time_end_pho',
-        suffixes=('', '_pho'),
-        direction='nearest',
-        tolerance=pd.Timedelta('0.5s'))
-
-    # Add orphan %pho's - if any - by merging with all the pho's on annotid.
-    # By merging on all the pho columns, we won't add any new columns.
-    # If multiple CHI cells were found to correspond to a single pho cell, this will result in duplicate columns. Same
-    # will happen if there identical pho rows.
-    pho_columns = [column + '_pho' for column in columns_to_keep]
-    chis_with_phos = chis_with_phos.merge(
-        df[is_pho][columns_to_keep].rename(columns=dict(zip(columns_to_keep, pho_columns))),
-        on=pho_columns,
-        how='outer'
-    )
-
-    return chis_with_phos
+    return pd.concat(
+        objs=chis_by_path.values(),
+        keys=chis_by_path.keys(),
+        names=['file_path', 'index']
+    ).reset_index(0)
+
+
+# # Sharding
+# To split the work between machines, run with --shard i/N (or --paths <file>) and --output-dir <shard dir>, then merge
+# the outputs with --merge <shard dir 0> ... <shard dir N-1> --output-dir <dir>. See shards.py.
+def add_arguments(parser):
+    parser.add_argument('--reports-only', action='store_true',
+                        help='Stop after writing the reports, don\'t change any files')
+    parser.add_argument('--index', type=Path, help='SQLite index to update with the results, see corpus_index.py')
+    parser.add_argument('--watch', action='store_true',
+                        help='After writing the reports, keep reprocessing the files that change and updating the '
+                             'reports, don\'t change any files')
+    parser.add_argument('--batch', type=Path, metavar='CHECKPOINT_DIR',
+                        help='Write the reports, listing the files that can\'t be processed instead of stopping. The '
+                             'progress is saved to this folder to resume from. Doesn\'t change any files.')
+    parser.add_argument('--migrate-mwu', action='store_true',
+                        help='After moving the pho cells, also move the ones that follow "%%com: first word" and '
+                             '"%%com: mwu" cells into the pho field of those cells')
+    parser.add_argument('--profile', type=Path, metavar='REPORT_PATH',
+                        help='Record the time, bytes, cells, and peak memory of each stage for each file and write '
+                             'them to REPORT_PATH.json (totals by stage) and REPORT_PATH.csv when the script stops, '
+                             'see opf_profiling.py')
+
+
+args = shards.parse_args(description='Check and update the pho cells/fields in the opf files.',
+                         add_arguments=add_arguments)
+reports_dir = args.output_dir or Path('reports')
+
+if args.profile:
+    profiler = opf_profiling.enable()
+    # Written however the script stops: at the end, after the reports in the read-only modes, or at a failed check
+    atexit.register(lambda: print('Profile written to {} and {}'.format(*profiler.write_report(args.profile))))
+
+if args.merge:
+    all_chis_with_phos = pd.concat(objs=[pd.read_pickle(shard_dir / MATCHED_TABLE_FILENAME)
+                                         for shard_dir in args.merge])
+    build_reports(all_chis_with_phos, output_dir=reports_dir)
+    print(f'Reports of {len(args.merge)} shards merged into {reports_dir}')
+    raise SystemExit
 
 
 # # Main
 
 # locate all the opf files
 seedlings_path = Path('/Volumes/pn-opus/Seedlings')
-assert seedlings_path.exists()
-
-opf_file_path_list = seedlings_path.joinpath('Scripts_and_Apps/Github/seedlings/path_files/opf_paths.txt')
+if args.path_list:
+    opf_file_path_list = args.path_list
+else:
+    assert seedlings_path.exists()
+    opf_file_path_list = seedlings_path.joinpath('Scripts_and_Apps/Github/seedlings/path_files/opf_paths.txt')
 assert opf_file_path_list.exists()
 
 with opf_file_path_list.open('r', encoding='utf-8') as f:
     opf_paths = [Path(path.rstrip()) for path in f]
 
-
-# Read and convert to dataframes
-opf_files = list(map(OPFFile, opf_paths))
-for of in opf_files:
-    of.load()
-opf_dfs = list(map(OPFDataFrame, opf_files))
-
-
-problems = [df for df in opf_dfs if not df.can_be_reversed()]
-assert len(problems) == 0
-
-
-# Find all the CHIs, the corresponding phos, and classify them
-all_chis_with_phos = pd.concat(
-    objs=map(collect_all_chi, opf_dfs),
-    keys=[opf.path for opf in opf_files],
-    names=['file_path', 'index']
-).reset_index(0)
-
-
-# # Find all the orphan phos
-orphans = all_chis_with_phos[all_chis_with_phos.object.isna()].copy()
-
-# Clean
-# A random date was added to time for technical reasons, we don't need it anymore
-orphans.time_end_pho = orphans.time_end_pho.dt.time
-orphans = orphans[['file_path', 'object_pho', 'id_pho', 'time_start_pho', 'time_end_pho']]
-
-
-# Save
-orphans_output_path = Path('reports') / 'orphan_phos.csv'
-orphans_output_path.parent.mkdir(exist_ok=True)
-orphans.to_csv(orphans_output_path, index=False)
-
-
-# Find all the non-unique ids (not one-to-one matches)
-
-# These column combinations are supposed to be unique
-unique_chi_columns = ['file_path', 'id', 'time_start', 'time_end']
-unique_pho_columns = ['file_path', 'id_pho', 'time_start_pho', 'time_end_pho']
-
-duplicates = pd.concat(
-        objs=[all_chis_with_phos[(
-                all_chis_with_phos.duplicated(subset=unique_chi_columns, keep=False)
-                & ~all_chis_with_phos.object.isna())],  # don't count empty rows as duplicates of each other
-              all_chis_with_phos[(
-                all_chis_with_phos.duplicated(subset=unique_pho_columns, keep=False)
-                & ~all_chis_with_phos.object_pho.isna())]],
-        keys=['CHIs sharing a %pho', '%phos sharing a CHI'],
-        names=['duplicate_type', 'index']
-    ).reset_index(0)
-
-duplicates_output_path = Path('reports') / 'duplicates.csv'
-duplicates_output_path.parent.mkdir(exist_ok=True)
-duplicates.to_csv(duplicates_output_path, index=False)
+opf_paths = shards.paths_to_process(args, opf_paths)
 
 
-# Classify based on pho field/cell presence and the transcription actually being there
-def add_flags(chis_with_phos):
-    """
-    Adds binary columns 'is_pho_cell', 'is_pho_cell_filled', 'is_pho_field', 'pho', 'is_pho_field_filled'
-    :param chis_with_phos: output of collect_all_chi
-    :return: chis_with_phos with four additional columns.
-    """
-
-    # Is there a pho cell?
-    chis_with_phos['is_pho_cell'] = ~chis_with_phos.object_pho.isna()
-
-    # Does it have anything in it?
-    # First, check that they all have the same prefix "%pho: " (all() does not care about NaNs)
-    assert chis_with_phos.object_pho.str.contains(PHO_PREFIX).all()
-    # Is there at least one character after the prefix?
-    chis_with_phos['is_pho_cell_filled'] = (
-        (chis_with_phos.object_pho
-         # Remove the prefix
-         .str.replace(PHO_PREFIX, '', regex=True)
-         # Is there anything left?
-         .str.len() > 0)
-        # We want NaN, not False when there was no pho field
-        .where(chis_with_phos.is_pho_cell)
-    )
-
-    # Is there a pho field?
-    # If there was, and it was empty, then it would equal to '' now; if there wasn't, it would now be NaN.
-    chis_with_phos['is_pho_field'] = ~chis_with_phos.pho.isna()
-
-    # Does it have anything in it?
-    # First, check that they all have the same prefix "%pho: "
-    assert chis_with_phos.object_pho.str.contains(PHO_PREFIX).all()
-    # Is there at least one character after the prefix?
-    chis_with_phos['is_pho_field_filled'] = (
-        (chis_with_phos.pho
-         # Remove the prefix
-         .str.replace(PHO_PREFIX, '', regex=True)
-         # Is there anything left?
-         .str.len() > 0)
-        # We want NaN, not False when there was no pho field
-        .where(chis_with_phos.is_pho_field))
-
-    return chis_with_phos
-
+# Parsed dataframes are cached between the sessions, stale entries are replaced automatically
+opf_cache = OPFCache(Path('.opf_cache'))
 
-all_chis_with_phos_with_flags = add_flags(all_chis_with_phos)
 
+# Batch mode
+# A file that fails to load or can't be reversed is listed in the error report instead of stopping everything. The files
+# that passed are recorded in the checkpoint folder and are not processed again unless they change.
+if args.batch:
+    def process(path, data):
+        opf_df = OPFDataFrame(OPFFile(path, load_db=False, data=data, lazy=True), cache=opf_cache, compact=True)
+        if not opf_df.can_be_reversed():
+            raise ValueError('db can\'t be reconstructed from the dataframe')
+        return collect_all_chi(opf_df)
 
-# Inconsistent transcriptions
-# These are annotations that have both the pho cell and the pho column filled
-inconsistent_ones = all_chis_with_phos_with_flags[
-    all_chis_with_phos_with_flags.is_pho_cell_filled
-    & all_chis_with_phos_with_flags.is_pho_field_filled]
+    chis_by_path, failures = run_batch(opf_paths, process, Checkpoint(args.batch))
+    write_error_report(failures, reports_dir / ERROR_REPORT_FILENAME)
+    if chis_by_path:
+        build_reports(concat_chis(chis_by_path), output_dir=reports_dir)
+    print(f'{len(chis_by_path)} files processed without errors, reports written to {reports_dir.absolute()}')
+    raise SystemExit
 
-inconsistent_output_path = Path('reports') / 'inconsistent_ones.csv'
-inconsistent_output_path.parent.mkdir(exist_ok=True)
-inconsistent_ones.to_csv(inconsistent_output_path, index=False)
 
-
-# Make summary tables
-def make_pivot(chis):
-    return (chis
-            .groupby(['is_pho_cell', 'is_pho_cell_filled', 'is_pho_field', 'is_pho_field_filled'], dropna=False)
-            .size()
-            .to_frame('size')
-            .reset_index())
-
-
-make_pivot(all_chis_with_phos_with_flags)
-
-
-# Filter odd ones
+# Read and convert to dataframes
+# The dataframes are built from db streamed from the archives, no need to also keep it in memory
+# The archives are read from the network share concurrently, ahead of the one being parsed
+# The files with an up-to-date cache entry aren't read at all unless they are written to
+is_cached = {path: opf_cache.is_fresh(path) for path in opf_paths}
+prefetched = iter(PrefetchingReader([path for path in opf_paths if not is_cached[path]]))
+# Each archive is parsed as soon as it is read, which frees it before the next one is taken from the prefetcher
+opf_files, opf_dfs = list(), list()
+for path in opf_paths:
+    if is_cached[path]:
+        opf_file = OPFFile(path, load_db=False, lazy=True)
+    else:
+        _, data = next(prefetched)
+        opf_file = OPFFile(path, load_db=False, data=data)
+        del data
+    # With all the files loaded at once, memory adds up - use compact dtypes
+    opf_dfs.append(OPFDataFrame(opf_file, cache=opf_cache, compact=True))
+    opf_files.append(opf_file)
+opf_corpus = OPFCorpus(opf_dfs)
 
 
-full = all_chis_with_phos_with_flags
-is_odd = (full.id_pho.isin(orphans.id_pho) |
-          full.id.isin(duplicates.id) | full.id_pho.isin(duplicates.id_pho) |
-          full.id.isin(inconsistent_ones.id))
+problems = [df for df in opf_dfs if not df.can_be_reversed()]
+assert len(problems) == 0
 
-# The remaining duplicates are not really duplicates, they are just two utterance and then one pho cell.
-# The timestamp of the pho cell corresponds exactly to the timestamp of the second CHI cell.
-is_odd = is_odd & ~full.id.isin(duplicates[duplicates.time_end == duplicates.time_end_pho].id)
 
+# Find all the CHIs, the corresponding phos, and classify them
+chis_by_path = {opf.path: collect_all_chi(opf_df) for opf, opf_df in zip(opf_files, opf_dfs)}
+all_chis_with_phos = concat_chis(chis_by_path)
+
+
+if shards.is_sharded(args):
+    reports_dir.mkdir(parents=True, exist_ok=True)
+    all_chis_with_phos.to_pickle(reports_dir / MATCHED_TABLE_FILENAME)
+
+
+# Flag and classify them, write the reports
+reports = build_reports(all_chis_with_phos, output_dir=reports_dir)
+full = all_chis_with_phos_with_flags = reports.full
+orphans, duplicates, inconsistent_ones = reports.orphans, reports.duplicates, reports.inconsistent_ones
+is_odd = reports.is_odd
+
+reports.summary
+
+# Update the query index - only the files that changed since they were last indexed
+if args.index:
+    with CorpusIndex(args.index) as index:
+        index.index_opf_files(full, paths=index.changed_paths(opf_paths))
+
+# Watch mode - the report rows are kept for each file, only the ones of the changed files are recomputed
+if args.watch:
+    reports_by_path = {path: build_reports(concat_chis({path: chis})) for path, chis in chis_by_path.items()}
+
+    def reprocess(changed_paths):
+        for path in changed_paths:
+            if not path.exists():
+                reports_by_path.pop(path, None)
+                continue
+            try:
+                opf_df = OPFDataFrame(OPFFile(path, load_db=False, lazy=True), cache=opf_cache, compact=True)
+                reports_by_path[path] = build_reports(concat_chis({path: collect_all_chi(opf_df)}))
+            except Exception as e:
+                # Probably saved in the middle of an edit, the previous rows are kept until the next save
+                print(f'Could not process {path}: {e!r}')
+        write_reports(combine_reports([reports_by_path[path] for path in opf_paths if path in reports_by_path]),
+                      reports_dir)
+        if args.index:
+            indexed_paths = [path for path in changed_paths if path in reports_by_path and path.exists()]
+            with CorpusIndex(args.index) as index:
+                if indexed_paths:
+                    index.index_opf_files(pd.concat([reports_by_path[path].full for path in indexed_paths]),
+                                          paths=indexed_paths)
+                for path in changed_paths:
+                    if not path.exists():
+                        index.remove(path)
+
+    watch(opf_paths, reprocess)
+    raise SystemExit
+
+if args.reports_only:
+    raise SystemExit
 
-make_pivot(all_chis_with_phos_with_flags[~is_odd])
 
 # Add the pho field
 no_pho_field_paths = full[~is_odd & ~full.is_pho_field].file_path.unique()
-no_pho_field_dfs = [opf_df for opf_df in opf_dfs if opf_df.opf_file.path in no_pho_field_paths]
+no_pho_field_dfs = [opf_corpus[path] for path in no_pho_field_paths]
 assert len(no_pho_field_paths) == len(no_pho_field_dfs)
 assert not any('pho' in opf_df.df.columns for opf_df in no_pho_field_dfs)
 
@@ -224,18 +216,22 @@ assert no_pho_field_paths.size == 0
 backup_dir = seedlings_path / 'Compiled_Data/annotated_opf/annotated_opf'
 assert backup_dir.exists()
 
-for opf_df in no_pho_field_dfs:
-    if 'pho' in opf_df.column_definitions or 'pho' in opf_df.df.columns:
-        raise ValueError('pho is already a field')
 
-    opf_df.column_definitions += ',pho|NOMINAL'
-    opf_df.df['pho'] = ''
+def to_backup(path):
+    return backup_path_for(path, backup_dir)
 
-    opf_df.opf_file.db = str(opf_df)
 
-    # Write to backup first, commit changes
-    output_path = backup_dir / opf_df.opf_file.path.stem
-    opf_df.opf_file.write(path=output_path, unzipped=True)
+# The changes are recorded and replayed onto the backups and then the originals. Only the changed files are rewritten,
+# replaying a log twice changes nothing.
+operation_log = OperationLog()
+for opf_df in no_pho_field_dfs:
+    opf_df.add_field('pho')
+    opf_df.update_db()
+    record_add_field(operation_log, opf_df.opf_file.path, 'pho', column=opf_df.column_name)
+
+# Write to backup first, commit changes
+replay(operation_log, OPF_APPLIERS, target_for=to_backup)
+operation_log.save(reports_dir / OPERATION_LOG_FILENAME, append=True)
 
 
 # os.chdir(backup_dir.parent)
@@ -247,89 +243,48 @@ is_pho_in_cell = (~is_odd & full.is_pho_cell & full.is_pho_cell & full.is_pho_fi
                   full.is_pho_field_filled.isin((False, float('nan'))))
 
 
-for path, sub_df in full[is_pho_in_cell].groupby('file_path'):
-    opf_df = next(opf_df for opf_df in opf_dfs if opf_df.opf_file.path == path)
-
-    # Remember column order so that we can put the id column back in the end
-    original_column_order = opf_df.df.columns.copy()
-    opf_df.df.set_index('id', inplace=True)
-
-    # update the pho field
-    for _, row in sub_df.iterrows():
-        opf_df.df.at[row.id, 'pho'] = row.object_pho
-
-    # drop pho cells
-    opf_df.df.drop(index=sub_df.id_pho.to_list(), inplace=True)
-
-    # restore the index column
-    opf_df.df.reset_index(inplace=True)
-    opf_df.df = opf_df.df[original_column_order]
-
+operation_log = OperationLog()
+for opf_df in opf_corpus.move_pho(full[is_pho_in_cell], operation_log=operation_log):
     # compile and update db
-    opf_df.opf_file.db = str(opf_df)
+    opf_df.update_db()
 
-    # Write to backup
-    output_path = backup_dir / opf_df.opf_file.path.stem
-    opf_df.opf_file.write(path=output_path, unzipped=True)
+# Write to backup
+replay(operation_log, OPF_APPLIERS, target_for=to_backup)
+operation_log.save(reports_dir / OPERATION_LOG_FILENAME, append=True)
 
 assert is_pho_in_cell.sum() == 0
 # If stopped here, check the backup repo and commit before proceeding
 
 if is_pho_in_cell.sum() > 0:
     # Overwrite the original files
-    for path, sub_df in full[is_pho_in_cell].groupby('file_path'):
-        opf_df = next(opf_df for opf_df in opf_dfs if opf_df.opf_file.path == path)
-        opf_df.opf_file.write(overwrite_original=True)
+    replay(operation_log, OPF_APPLIERS)
 
-    opf_backup_script = seedlings_path / 'Scripts_and_Apps/Github/seedlings/path_files/cp_all_opf.sh'
-    os.system(f'bash {opf_backup_script} {opf_file_path_list} {backup_dir}')
-
-    cwd = os.getcwd()
-    try:
-        os.chdir(backup_dir)
-        os.system('git status')
-    finally:
-        os.chdir(cwd)
+    # Update the backup - only the files that differ from their backups are rewritten
+    changed_paths = sync_to_backup(opf_paths, backup_dir)
 
     # check that nothing has changed in the backup
+    assert len(changed_paths) == 0, changed_paths
+
 
+# Multi-word-utterances and first words
+# Those also have pho cells associated with them: the pho cell right after the "%com: first word" or "%com: mwu" cell.
+# A one-off migration, only run with --migrate-mwu.
+if args.migrate_mwu:
+    operation_log = OperationLog()
+    mwu_dfs = opf_corpus.move_phos_after_comments(operation_log=operation_log)
+    for opf_df in mwu_dfs:
+        opf_df.update_db()
 
-# # # Multi-word-utterances and first words
-# # Those also have pho cells associated with them
-# for opf_df in opf_dfs:
-#     is_pho = opf_df.df.object.str.contains(PHO_PREFIX)
-#     if is_pho.sum() == 0:
-#         continue
-#
-#     pho_indices_to_drop = list()
-#     for index, row in opf_df.df[is_pho].iterrows():
-#         previous_object = opf_df.df.loc[index - 1].object
-#         if (previous_object.startswith('%com: first word') or
-#                 previous_object.startswith('%com: mwu')):
-#             # copy the transcription from the pho cell
-#             opf_df.df.loc[index - 1].pho = row.object
-#             pho_indices_to_drop.append(index)
-#
-#     if pho_indices_to_drop:
-#         opf_df.df.drop(index=pho_indices_to_drop, inplace=True)
-#         opf_df.opf_file.db = str(opf_df)
-#         output_path = backup_dir / opf_df.opf_file.path.stem
-#         opf_df.opf_file.write(path=output_path, unzipped=True)
-#
-# # Stop execution here so that we don't proceed until manually checking and committing the backup
-# 1/0
-
-# # Update the original files, once checked and committed the backukp
-# for opf_df in opf_dfs:
-#     opf_df.opf_file.write(overwrite_original=True)
-#
-# # Run the backup script
-# opf_backup_script = seedlings_path / 'Scripts_and_Apps/Github/seedlings/path_files/cp_all_opf.sh'
-# os.system(f'bash {opf_backup_script} {opf_file_path_list} {backup_dir}')
-#
-# cwd = os.getcwd()
-# try:
-#     os.chdir(backup_dir)
-#     os.system('git status')
-# finally:
-#     os.chdir(cwd)
+    # Write to backup
+    replay(operation_log, OPF_APPLIERS, target_for=to_backup)
+    operation_log.save(reports_dir / OPERATION_LOG_FILENAME, append=True)
+
+    # Unlike the steps above, this doesn't stop for a check of the backup repo: the flag is the go-ahead
+    if mwu_dfs:
+        # Overwrite the original files the same way, so that they match their backups byte for byte
+        replay(operation_log, OPF_APPLIERS)
+
+        # Update the backup - there should be no changes
+        changed_paths = sync_to_backup(opf_paths, backup_dir)
+        assert len(changed_paths) == 0, changed_paths
+    print(f'Pho cells after comments moved in {len(mwu_dfs)} files')
@@ -1,38 +1,321 @@
 import re
+import io
+import hashlib
+import itertools
 import os
-from zipfile import ZipFile, ZIP_DEFLATED
+import mmap
+import zlib
+from stat import S_IMODE
+from collections.abc import Mapping
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED
 import tempfile
 from pathlib import Path
 
 import pandas as pd
 
+import opf_profiling
+
 
 # This is not exactly correct. datavyu uses milliseconds and this uses microseconds adding three extra zeros
 DATETIME_FORMAT = '%H:%M:%S:%f'
+TIME_COLUMNS = ('time_start', 'time_end')
+# Start of the object of the cells with phonetic transcriptions
+PHO_PREFIX = r'^%pho:?(?:&|\s+)'
+# Comment cells that have their transcription in the pho cell right after them
+COMMENT_PREFIXES_WITH_PHO = ('%com: first word', '%com: mwu')
+# zlib compression level for the copies that don't need to be small, e.g., scratch or backup archives
+FAST_COMPRESSLEVEL = 1
+
+# Read once - os.umask can only be read by setting it, which is not thread-safe
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def rstripped_lines(lines):
+    """
+    Lazy equivalent of ''.join(lines).rstrip().split('\n') for lines without the line endings: drops the trailing
+    whitespace-only lines and strips the whitespace from the end of the last remaining line.
+    :param lines: iterable of str
+    :return: generator of str
+    """
+    # Lines that might turn out to be at the very end. The first one is the last non-blank line seen so far.
+    held = list()
+    for line in lines:
+        if line.strip():
+            yield from held
+            held = [line]
+        else:
+            held.append(line)
+    if held and held[0].strip():
+        yield held[0].rstrip()
+
+
+def times_to_milliseconds(times: pd.Series):
+    """
+    Converts datavyu timestamps (HH:MM:SS:mmm) to the number of milliseconds
+    :param times: series of str
+    :return: series of int64
+    """
+    parts = times.str.split(':', expand=True).astype('int64')
+    return ((parts[0] * 60 + parts[1]) * 60 + parts[2]) * 1000 + parts[3]
+
+
+def milliseconds_to_times(milliseconds: pd.Series):
+    """
+    Inverse of times_to_milliseconds
+    :param milliseconds: series of int
+    :return: series of str
+    """
+    seconds, ms = milliseconds // 1000, milliseconds % 1000
+    minutes, seconds = seconds // 60, seconds % 60
+    hours, minutes = minutes // 60, minutes % 60
+    return (hours.astype(str).str.zfill(2) + ':' + minutes.astype(str).str.zfill(2) + ':'
+            + seconds.astype(str).str.zfill(2) + ':' + ms.astype(str).str.zfill(3))
+
+
+# A line of "db" that defines a datavyu column: <column name> (<column type>,<visible>,<options>)-<field definitions>
+COLUMN_DEFINITION_PATTERN = re.compile(r'(?P<name>.+?) \((?P<options>[^()]*)\)-(?P<fields>.*)')
+# A line of "db" that is a cell: <time_start>,<time_end>,(<field1>,...,<fieldN>)
+CELL_PATTERN = re.compile(r'\d+:\d{2}:\d{2}:\d{3},')
+# Separates the values in a cell. Commas within field values are escaped by a backslash - we don't split on those
+FIELD_SEPARATOR = re.compile(r'(?<!\\),')
+
+
+def is_column_definition(line):
+    return CELL_PATTERN.match(line) is None and COLUMN_DEFINITION_PATTERN.fullmatch(line) is not None
+
+
+def column_name_of(column_definitions):
+    return COLUMN_DEFINITION_PATTERN.fullmatch(column_definitions).group('name')
+
+
+def field_names_of(column_definitions):
+    """
+    Extracts the field names from a column definition line of "db".
+    :param column_definitions: the line defining the datavyu column
+    :return: list of str, starting with time_start and time_end
+    """
+    match = COLUMN_DEFINITION_PATTERN.fullmatch(column_definitions)
+    if match is None:
+        raise ValueError(f'Not a datavyu column definition: {column_definitions}')
+    # Field definitions are comma-separated, each definition has the following format: <field_name>|<field_type>
+    field_names = [field_definition.split('|')[0] for field_definition in match.group('fields').split(',')]
+    # The first two columns contain timestamps
+    return list(TIME_COLUMNS) + field_names
+
+
+def db_columns(lines):
+    """
+    Splits the lines of "db" that follow the prefix line into datavyu columns. Each column starts with its definition
+    line and continues until the next definition line. The first line is always taken to be a definition.
+    :param lines: iterable of str, without the prefix line
+    :return: generator of (column definition, iterator over the cell lines). Each iterator has to be consumed before
+    moving on to the next column.
+    """
+    column_count = 0
+
+    def column_number(line):
+        nonlocal column_count
+        if is_column_definition(line):
+            column_count += 1
+        return column_count
+
+    for _, column_lines in itertools.groupby(lines, key=column_number):
+        yield next(column_lines), column_lines
+
+
+def cell_to_values(cell, n_fields):
+    """
+    Splits a line of "db" into the values of the fields.
+    :param cell: line in this format: <time_start>,<time_end>,(<field1>,...,<fieldN>)
+    :param n_fields: number of fields including the time ones
+    :return: list of str
+    """
+    values = cell.split(',', maxsplit=2)
+    values = values[:2] + FIELD_SEPARATOR.split(values[2].strip('()'))
+    # If, for some reason, a row is missing commas (not just values!), pad it with empty fields
+    values = values + [''] * (n_fields - len(values))
+    return values
+
+
+def values_to_cell(values):
+    """
+    Inverse of cell_to_values
+    """
+    return f'{values[0]},{values[1]},({",".join(values[2:])})'
+
+
+def row_hashes(df):
+    """
+    :return: uint64 array with a hash of the values in each row, used to find the rows that changed
+    """
+    return pd.util.hash_pandas_object(df, index=False).to_numpy()
+
+
+def serialize_cells(df):
+    """
+    Converts each row to the db format: <time>,<time>,(<col1>,...,<col2>)
+    :return: series of str
+    """
+    if len(df) == 0:
+        return pd.Series(index=df.index, dtype=object)
+
+    time_columns = list(TIME_COLUMNS)
+    other_columns = ~df.columns.isin(time_columns)
+    return (pd.concat([
+        # Time columns, converted back to text if they were compacted
+        df.loc[:, time_columns].apply(
+            lambda times: milliseconds_to_times(times) if pd.api.types.is_integer_dtype(times) else times),
+        # All the other columns put together in parentheses and separated by commas
+        df.loc[:, other_columns]
+          .astype(str)
+          .agg(lambda values: f'({",".join(values)})', axis=1)
+        ], axis=1)
+        .agg(','.join, axis=1)
+    )
+
+
+class DatavyuColumn(object):
+    """
+    A datavyu column kept as the lines of "db" it was read from. The cells are only split into values when the
+    dataframe is first accessed. Until the dataframe is changed, the column is written back from the original lines.
+    """
+    def __init__(self, definition, lines):
+        """
+        :param definition: the column definition line
+        :param lines: list of the cell lines
+        """
+        self.definition = definition
+        self.name = column_name_of(definition)
+        self.lines = lines
+        self._df = None
+        self._modified = False
+
+    @property
+    def is_loaded(self):
+        return self._df is not None
+
+    @property
+    def df(self):
+        if self._df is None:
+            field_names = field_names_of(self.definition)
+            self._df = pd.DataFrame(columns=field_names,
+                                    data=[cell_to_values(line, n_fields=len(field_names)) for line in self.lines])
+        return self._df
+
+    @df.setter
+    def df(self, df):
+        self._df = df
+        self._modified = True
+
+    def mark_modified(self):
+        """
+        Marks df as changed. Needed after editing df in place, otherwise the original lines are written.
+        """
+        self._modified = True
+
+    def is_modified(self):
+        return self._modified
+
+    def update_lines(self):
+        """
+        Makes the current state of df the original one.
+        """
+        if self._modified:
+            self.lines = serialize_cells(self._df).to_list()
+            self._modified = False
+
+    def __str__(self):
+        cells = serialize_cells(self._df).to_list() if self._modified else self.lines
+        return '\n'.join([self.definition, *cells])
+
+
+class LazyComponents(Mapping):
+    """
+    Read-only mapping of the archive member names to their contents. The contents are read from the unzipped opf folder
+    each time they are accessed.
+    """
+    def __init__(self, folder_path: Path, names):
+        self.folder_path = folder_path
+        self.names = list(names)
+
+    def __getitem__(self, name):
+        if name not in self.names:
+            raise KeyError(name)
+        return (self.folder_path / name).read_bytes()
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
 
 
 class OPFFile(object):
     SKIP_PREFIXES = ('.DS_Store', '__MACOSX/')
 
-    def __init__(self, path):
+    def __init__(self, path, load_db=True, data=None, lazy=False):
+        """
+        :param path: path to the .opf file or to the folder with its unzipped contents
+        :param load_db: whether to keep the decoded "db" in memory. If False, use iter_db_lines to read it.
+        :param data: contents of the .opf file if they have already been read, e.g., by prefetch.PrefetchingReader.
+        They are dropped once they have been decoded, see release_data - anything needed later is read from path.
+        :param lazy: don't load anything until db or the other components are needed, e.g., when OPFDataFrame reads
+        the parsed dataframe from OPFCache and the file is not written
+        """
         self.path = path
+        self.load_db = load_db
+        self.data = data
         self.loaded = False
         self.db = None
+        self.db_info = None
         self.other_components = None
         self.filenames_in_archive = None
-        self.load()
+        if not lazy:
+            self.load()
+
+    def _is_dir(self):
+        return self.data is None and self.path.is_dir()
+
+    def _zip_file(self):
+        return ZipFile(io.BytesIO(self.data) if self.data is not None else self.path, 'r')
+
+    def ensure_loaded(self):
+        if not self.loaded:
+            self.load()
 
     def load(self):
-        if self.path.is_dir():
-            raise NotImplementedError('Reading unarchived version from a folder is not yet implemented')
+        with opf_profiling.stage('load', self.path) as measurement:
+            if self._is_dir():
+                self._load_from_dir()
+            else:
+                self._load_from_zip()
+            # With load_db=False, db is decompressed while it is parsed and counted there
+            if self.db is not None:
+                measurement.set(bytes=self.db_info.file_size)
+        # Everything has been decoded, no need to keep the archive in memory too
+        if self.db is not None:
+            self.data = None
 
-        with ZipFile(self.path, 'r') as opf_zipped:
+    def release_data(self):
+        """
+        Drops the contents passed as data, e.g., once db has been parsed. Anything needed afterwards is read from path.
+        """
+        self.data = None
+
+    def _load_from_zip(self):
+        with self._zip_file() as opf_zipped:
             assert 'db' in opf_zipped.namelist(), f'The file at {self.path} does not contain "db". Not an OPF file?'
 
             # Annotations
-            with opf_zipped.open('db', 'r') as db_zipped:
-                # ZipFile.open reads files in the binary mode
-                db = db_zipped.read().decode('utf-8')
+            # The zip entry metadata (size, CRC) is kept so that we can tell whether "db" has changed without
+            # decompressing it.
+            db_info = opf_zipped.getinfo('db')
+            db = None
+            if self.load_db:
+                with opf_zipped.open('db', 'r') as db_zipped:
+                    # ZipFile.open reads files in the binary mode
+                    db = db_zipped.read().decode('utf-8')
 
             filenames_in_archive = opf_zipped.namelist()
 
@@ -46,18 +329,103 @@ class OPFFile(object):
                 if name != 'db'}
 
             self.db = db
+            self.db_info = db_info
             self.filenames_in_archive = filenames_in_archive
             self.other_components = other_components
             self.loaded = True
 
+    def _load_from_dir(self):
+        """
+        Loads an unzipped opf file, e.g., one written with write(unzipped=True). "db" is decoded straight from a
+        memory-mapped file, the other components are only read when they are accessed.
+        """
+        db_path = self.path / 'db'
+        assert db_path.exists(), f'The folder at {self.path} does not contain "db". Not an OPF file?'
+
+        with db_path.open('rb') as f:
+            if db_path.stat().st_size == 0:
+                db, crc, size = '', 0, 0
+            else:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as db_mapped:
+                    db = str(db_mapped, 'utf-8') if self.load_db else None
+                    crc, size = zlib.crc32(db_mapped), len(db_mapped)
+
+        # Same metadata we would have had if the folder was zipped
+        db_info = ZipInfo('db')
+        db_info.CRC, db_info.file_size = crc, size
+
+        filenames_in_archive = sorted(path.relative_to(self.path).as_posix()
+                                      for path in self.path.rglob('*') if path.is_file())
+        # Skip macos-specific hidden files
+        filenames_in_archive = [fn for fn in filenames_in_archive
+                                if not any(fn.startswith(prefix) for prefix in self.SKIP_PREFIXES)]
+        # Put db first, the way datavyu does
+        filenames_in_archive.remove('db')
+        filenames_in_archive = ['db'] + filenames_in_archive
+
+        self.db = db
+        self.db_info = db_info
+        self.filenames_in_archive = filenames_in_archive
+        self.other_components = LazyComponents(self.path, filenames_in_archive[1:])
+        self.loaded = True
+
+    def iter_db_lines(self):
+        """
+        Iterates over the lines of "db" without the line endings. If db is not in memory, it is decoded incrementally
+        from the archive or the unzipped folder.
+        :return: generator of str
+        """
+        self.ensure_loaded()
+        if self.db is not None:
+            # Split on '\n' only, the way db.split('\n') does - not on '\r' or the other characters splitlines uses
+            for line in io.StringIO(self.db, newline='\n'):
+                yield line.rstrip('\n')
+            return
+
+        if self._is_dir():
+            with (self.path / 'db').open('r', encoding='utf-8', newline='\n') as db_text:
+                for line in db_text:
+                    yield line.rstrip('\n')
+            return
+
+        with self._zip_file() as opf_zipped, opf_zipped.open('db', 'r') as db_zipped:
+            with io.TextIOWrapper(db_zipped, encoding='utf-8', newline='\n') as db_text:
+                for line in db_text:
+                    yield line.rstrip('\n')
+
+    def read_db(self):
+        """
+        :return: "db" as one string, whether it is kept in memory or not
+        """
+        self.ensure_loaded()
+        if self.db is not None:
+            return self.db
+        if self._is_dir():
+            return (self.path / 'db').read_bytes().decode('utf-8')
+        with self._zip_file() as opf_zipped:
+            return opf_zipped.read('db').decode('utf-8')
+
     def read_in_editor(self):
+        if self.path.is_dir():
+            os.system(f'open {self.path / "db"}')
+            return
+
         zf = ZipFile(self.path)
         tempdir = tempfile.mkdtemp()
         zf.extractall(tempdir)
         db_path = os.path.join(tempdir, 'db')
         os.system(f'open {db_path}')
 
-    def write(self, path: Path = None, overwrite_original=False, unzipped=False):
+    def write(self, path: Path = None, overwrite_original=False, unzipped=False, compresslevel=None):
+        """
+        Writes the archive or its unzipped contents. Each file is first written to a temporary file next to it which
+        then replaces it, so an interrupted write never leaves a half-written file behind.
+        :param path: where to write
+        :param overwrite_original: write to self.path instead
+        :param unzipped: write the components to a folder instead of a zip archive
+        :param compresslevel: zlib compression level for the archive, 0-9, the zlib default if None. Use
+        FAST_COMPRESSLEVEL for scratch copies.
+        """
         if not path and not overwrite_original:
             raise ValueError('You haven\'t specified the path to write the files. If you want to overwrite the original'
                              ' file, set overwrite_original to True')
@@ -67,107 +435,427 @@ class OPFFile(object):
                              'those')
 
         path = path or self.path
+        self.ensure_loaded()
 
         if unzipped:
             if path.exists() and not path.is_dir():
                 raise ValueError('Unzipped is set to True but supplied path is not a directory.')
             else:
                 path.mkdir(parents=True, exist_ok=True)
-                self._write_to_dir(folder_path=path)
+                with opf_profiling.stage('write', path) as measurement:
+                    self._write_to_dir(folder_path=path)
+                    measurement.set(bytes=lambda: sum((path / filename).stat().st_size
+                                                      for filename in self.filenames_in_archive))
         else:
             if not path.name.endswith('.opf'):
                 raise ValueError('Supplied path does not end with .opf as expected')
             else:
-                self._write_to_opf(path)
+                with opf_profiling.stage('write', path) as measurement:
+                    self._write_to_opf(path, compresslevel=compresslevel)
+                    measurement.set(bytes=lambda: path.stat().st_size)
+
+    @staticmethod
+    def _replace_with(path: Path, write):
+        """
+        Calls write with a temporary file opened in the binary mode, then moves the temporary file to path.
+        """
+        with tempfile.NamedTemporaryFile(dir=path.parent, prefix=f'.{path.name}.', suffix='.tmp', delete=False) as f:
+            temp_path = Path(f.name)
+            try:
+                write(f)
+            except BaseException:
+                f.close()
+                temp_path.unlink()
+                raise
+        # Temporary files are only readable by the owner, give the file the permissions it had or would have had
+        os.chmod(temp_path, S_IMODE(path.stat().st_mode) if path.exists() else 0o666 & ~_UMASK)
+        os.replace(temp_path, path)
 
     def _write_to_dir(self, folder_path):
         for filename in self.filenames_in_archive:
-            filepath = folder_path / filename
             if filename == 'db':
-                with filepath.open('w') as f:
-                    f.write(''.join(self.db))
+                contents = self.read_db().encode('utf-8')
             else:
-                with filepath.open('wb') as f:
-                    f.write(self.other_components[filename])
-
-    def _write_to_opf(self, path):
-        with ZipFile(path, mode='w', compression=ZIP_DEFLATED) as opf_zipped:
-            for filename in self.filenames_in_archive:
-                if filename == 'db':
-                    opf_zipped.writestr('db', self.db)
-                else:
-                    opf_zipped.writestr(filename, self.other_components[filename])
+                # Read before writing - with an unzipped file overwriting itself, this is the same file
+                contents = self.other_components[filename]
+            self._replace_with(folder_path / filename, lambda f: f.write(contents))
+
+    def _write_to_opf(self, path, compresslevel=None):
+        def write(f):
+            with ZipFile(f, mode='w', compression=ZIP_DEFLATED, compresslevel=compresslevel) as opf_zipped:
+                for filename in self.filenames_in_archive:
+                    if filename == 'db':
+                        opf_zipped.writestr('db', self.read_db())
+                    else:
+                        opf_zipped.writestr(filename, self.other_components[filename])
+
+        self._replace_with(path, write)
 
 
 class OPFDataFrame(object):
-    def __init__(self, opf_file: OPFFile):
+    # Fields with just a handful of distinct values
+    CATEGORICAL_FIELDS = ('speaker', 'utterance_type', 'object_present')
+    # Used for the free-text fields when compact is set to True, requires pyarrow
+    TEXT_DTYPE = 'string[pyarrow]'
+
+    def __init__(self, opf_file: OPFFile, cache=None, compact=False, column=None):
+        """
+        :param opf_file: OPFFile object, it is only loaded if the dataframe isn't read from the cache
+        :param cache: optional OPFCache object. If supplied, the parsed dataframe is read from the cache when the cached
+        version is up-to-date and is written to the cache otherwise.
+        :param compact: whether to convert the columns to memory-lean dtypes, see compact()
+        :param column: name of the datavyu column to put in self.df, the first column if None. The other columns are
+        in self.other_columns and are only converted to dataframes when they are accessed, see column_df().
+        """
         self.opf_file = opf_file
+        self.column = column
         self.prefix = None
         self.column_definitions = None
-        self.df = self._opf_to_pandas_df()
-        # assert self._can_be_reversed()
+        # DatavyuColumn objects by name and the position of the column in self.df among all the columns
+        self.other_columns = dict()
+        self.column_position = 0
+        # Set while parsing: the digest of the original db (up to the trailing whitespace) and whether each cell could
+        # be converted back to exactly the same line
+        self.db_digest = None
+        self.reversible = None
+        self.df = self._load(cache)
+        # Parsed or read from the cache, the archive contents aren't needed anymore
+        opf_file.release_data()
+        if compact:
+            with opf_profiling.stage('compact', opf_file.path) as measurement:
+                self.compact()
+                measurement.set(cells=len(self.df))
+        self._reset_modification_tracking()
+
+    def _load(self, cache):
+        if cache is None:
+            return self._parse()
+
+        with opf_profiling.stage('read_cache', self.opf_file.path) as measurement:
+            cached = cache.get(self.opf_file.path)
+            if cached is not None:
+                measurement.set(cells=len(cached[1]))
+        if cached is not None:
+            attributes, df = cached
+            # Entries for a different column are reparsed and overwritten. No column means the first one.
+            is_same_column = (attributes.get('column') == self.column if self.column is not None
+                              else attributes.get('column_position') == 0)
+            if 'other_columns' in attributes and is_same_column:
+                self.prefix = attributes['prefix']
+                self.column_definitions = attributes['column_definitions']
+                self.other_columns = {column.name: column for column in
+                                      (DatavyuColumn(definition, lines) for definition, lines in
+                                       attributes['other_columns'])}
+                self.column_position = attributes['column_position']
+                self.db_digest = attributes['db_digest']
+                self.reversible = attributes['reversible']
+                return df
+
+        # Taken before parsing, so that an entry for a file changed in the meantime is stale
+        key = cache.key(self.opf_file.path)
+        df = self._parse()
+        cache.put(self.opf_file.path, df=df, key=key, prefix=self.prefix, column_definitions=self.column_definitions,
+                  column=column_name_of(self.column_definitions),
+                  other_columns=[(column.definition, column.lines) for column in self.other_columns.values()],
+                  column_position=self.column_position,
+                  db_digest=self.db_digest, reversible=self.reversible)
+        return df
+
+    def _parse(self):
+        with opf_profiling.stage('parse', self.opf_file.path) as measurement:
+            df = self._opf_to_pandas_df()
+            measurement.set(bytes=self.opf_file.db_info.file_size, cells=len(df))
+        return df
+
+    @staticmethod
+    def _digest(text):
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    # Number of cells converted to a dataframe at a time
+    CHUNK_SIZE = 10_000
 
     def _opf_to_pandas_df(self):
-        db_lines = self.opf_file.db.rstrip().split('\n')
-        # Sometimes the last line is empty - delete it
-        if not db_lines[-1]:
-            del db_lines[-1]
-        self.prefix = db_lines[0]
-        self.column_definitions = db_lines[1]
-
-        # Extract field names
-        # There is a single datavyu column "labeled_object" defined in the second line of "db".
-        # The format of this line is <column-definition>-<field_definitions>
-        field_definitions = self.column_definitions.split('-')[1]
-        # Field definitions are comma-separated, each definition has the following format: <field_name>|<field_type>
-        field_names = [field_definition.split('|')[0] for field_definition in field_definitions.split(',')]
-        # The first two columns contain timestamps
-        field_names = ['time_start', 'time_end'] + field_names
-
-        # Extract values
-        # Each data row in db is in this format: <time_start>,<time_end>,(<field1>,...,<fieldN>)
-        def row_to_values(row):
-            values = row.split(',', maxsplit=2)
-            # Commas within filed values are escaped by a backslash - we don't want to split on those
-            values = values[:2] + re.split(r'(?<!\\),', values[2].strip('()'))
-            # If, for some reason, a row is missing commas (not just values!), pad it with empty fields
-            values = values + [''] * (len(field_names) - len(values))
-            return values
-
-        data = list(map(row_to_values, db_lines[2:]))
-
-        # Bind
-        df = pd.DataFrame(columns=field_names, data=data)
+        # Same as db.rstrip().split('\n') but without having all of db in memory at once
+        digest = hashlib.sha1()
+
+        def digested(lines):
+            # Same as _digest('\n'.join(lines)), a chunk of lines at a time
+            separator = ''
+            for chunk in iter(lambda: list(itertools.islice(lines, self.CHUNK_SIZE)), []):
+                digest.update((separator + '\n'.join(chunk)).encode('utf-8'))
+                separator = '\n'
+                yield from chunk
+
+        db_lines = digested(rstripped_lines(self.opf_file.iter_db_lines()))
+        self.prefix = next(db_lines)
+
+        # One pass over the lines: the cells of the column we need are parsed, the others are kept as they are
+        df = None
+        for position, (column_definitions, cell_lines) in enumerate(db_columns(db_lines)):
+            if df is None and self.column in (None, column_name_of(column_definitions)):
+                self.column_definitions = column_definitions
+                self.column_position = position
+                df = self._cells_to_df(cell_lines, field_names_of(column_definitions))
+            else:
+                column = DatavyuColumn(column_definitions, list(cell_lines))
+                self.other_columns[column.name] = column
+        self.db_digest = digest.hexdigest()
 
+        if df is None:
+            raise ValueError(f'There is no column {self.column} in {self.opf_file.path}')
         return df
 
+    def _cells_to_df(self, cell_lines, field_names):
+        n_fields = itertools.repeat(len(field_names))
+
+        # Bind, one chunk at a time
+        chunks = list()
+        self.reversible = True
+        while True:
+            rows = list(itertools.islice(cell_lines, self.CHUNK_SIZE))
+            if not rows:
+                break
+            # Extract values
+            data = list(map(cell_to_values, rows, n_fields))
+            # The same format __str__ uses, checked for each line while we have it
+            self.reversible = self.reversible and rows == list(map(values_to_cell, data))
+            chunks.append(pd.DataFrame(columns=field_names, data=data))
+
+        if not chunks:
+            return pd.DataFrame(columns=field_names)
+        if len(chunks) == 1:
+            return chunks[0]
+        return pd.concat(chunks, ignore_index=True)
+
+    @property
+    def column_name(self):
+        """
+        Name of the datavyu column in self.df.
+        """
+        return column_name_of(self.column_definitions)
+
+    @property
+    def column_names(self):
+        """
+        Names of all the datavyu columns in the order they are in "db".
+        """
+        names = list(self.other_columns)
+        names.insert(self.column_position, column_name_of(self.column_definitions))
+        return names
+
+    def column_df(self, name):
+        """
+        :param name: name of a datavyu column
+        :return: self.df for the column self.df is for, the dataframe of one of self.other_columns otherwise. Changes
+        made to it in place are only written after mark_modified(name).
+        """
+        if name == column_name_of(self.column_definitions):
+            return self.df
+        return self.other_columns[name].df
+
+    def compact(self):
+        """
+        Converts columns to dtypes that take less memory: categoricals for the low-cardinality fields, int64
+        milliseconds for the times, and arrow-backed strings for everything else. A column is only converted if it
+        can be converted back to exactly the same strings, otherwise it is left as is.
+        :return: list of the names of the converted columns
+        """
+        df = self.df
+        converted = list()
+        for column in df.columns:
+            original = df[column]
+            if original.dtype != object and not pd.api.types.is_string_dtype(original):
+                # Already converted
+                continue
+            try:
+                if column in TIME_COLUMNS:
+                    compacted = times_to_milliseconds(original)
+                    reversed_ = milliseconds_to_times(compacted)
+                elif column in self.CATEGORICAL_FIELDS:
+                    compacted = original.astype('category')
+                    reversed_ = compacted.astype(str)
+                else:
+                    compacted = original.astype(self.TEXT_DTYPE)
+                    reversed_ = compacted.astype(str)
+            except (ValueError, TypeError):
+                # Unparseable timestamps
+                continue
+            except ImportError:
+                # No pyarrow - leave the text as is
+                continue
+
+            if (reversed_.astype(object) == original.astype(object)).all():
+                df[column] = compacted
+                converted.append(column)
+
+        return converted
+
+    # # Modification tracking
+    # Until the dataframe is changed, the original db is written back as it is. The methods that change the dataframe
+    # set a flag, and so should anything else that changes self.df - see mark_modified. Serializing the whole dataframe
+    # is slow, so we keep the serialized cells and, on the next write, only redo the rows whose hash has changed.
+
+    def _reset_modification_tracking(self):
+        self._modified = False
+        # Serialized cells aligned with self.df.index, the columns they were serialized with, and the row hashes at the
+        # time
+        self._serialized_cells = None
+        self._serialized_columns = None
+        self._serialized_hashes = None
+
+    def mark_modified(self, column=None):
+        """
+        Marks the dataframe as changed. Needed after editing self.df in place or replacing it, the methods of this
+        class that change it do that themselves.
+        :param column: name of the datavyu column that was changed, the one in self.df if None, see column_df
+        """
+        if column is None or column == column_name_of(self.column_definitions):
+            self._modified = True
+        else:
+            self.other_columns[column].mark_modified()
+
+    def is_modified(self):
+        """
+        Has the dataframe or any of the other columns been changed since it was loaded or written to opf_file.db?
+        """
+        return self._modified or any(column.is_modified() for column in self.other_columns.values())
+
+    def _serialized(self):
+        df = self.df
+        cells = self._serialized_cells
+        hashes = row_hashes(df)
+        can_reuse = (cells is not None
+                     and self._serialized_columns == df.columns.to_list()
+                     and df.index.is_unique)
+        if not can_reuse:
+            cells = serialize_cells(df)
+        else:
+            # Dropped rows disappear, added ones are NaN
+            cells = cells.reindex(df.index)
+            old_hashes = self._serialized_hashes.reindex(df.index)
+            to_update = cells.isna().to_numpy() | (old_hashes.to_numpy() != hashes)
+            if to_update.any():
+                cells[to_update] = serialize_cells(df[to_update])
+
+        self._serialized_cells = cells
+        self._serialized_columns = df.columns.to_list()
+        self._serialized_hashes = pd.Series(hashes, index=df.index)
+        return cells
+
     def __str__(self):
         """
-        Converts back to text format
+        Converts back to text format. Without any changes, that is the original db.
         :return: str
         """
-        # Reformat data into single column of the format <time>,<time>,(<col1>,...,<col2>)
+        if not self.is_modified():
+            return self.opf_file.read_db().rstrip()
+
+        with opf_profiling.stage('serialize', self.opf_file.path) as measurement:
+            columns = [str(column) for column in self.other_columns.values()]
+            columns.insert(self.column_position, '\n'.join([self.column_definitions, *self._serialized().to_list()]))
+            db = '\n'.join([self.prefix, *columns])
+            measurement.set(bytes=len(db), cells=len(self.df))
+        return db
+
+    def update_db(self):
+        """
+        Writes the current state to opf_file.db. This becomes the new original state for can_be_reversed.
+        :return: None
+        """
+        if not self.is_modified():
+            # opf_file.db is already up-to-date
+            return
+        db = str(self)
+        self.opf_file.ensure_loaded()
+        self.opf_file.db = db
+        for column in self.other_columns.values():
+            column.update_lines()
+        self.db_digest = self._digest(db)
+        self.reversible = True
+        # The serialized cells are kept for the next write
+        self._modified = False
+
+    def add_field(self, name, value='', field_type='NOMINAL'):
+        """
+        Adds a field to the datavyu column, e.g. pho|NOMINAL
+        :param name: field name
+        :param value: value for all the cells
+        :param field_type: datavyu field type
+        :return: None
+        """
+        if name in self.column_definitions or name in self.df.columns:
+            raise ValueError(f'{name} is already a field')
+        self.column_definitions += f',{name}|{field_type}'
+        self.df[name] = value
+        self.mark_modified()
+
+    def move_pho(self, pho_by_id: pd.Series, ids_to_drop):
+        """
+        Sets the pho field of some cells and drops other cells - the ones the transcriptions were taken from.
+        :param pho_by_id: pho values indexed by the id of the cell they should be put into
+        :param ids_to_drop: ids of the cells to drop
+        :return: None
+        """
         df = self.df
-        time_columns = ('time_start', 'time_end')
-        other_columns = ~df.columns.isin(time_columns)
-        data = (pd.concat([
-            # Time columns
-            df.loc[:, time_columns],
-            # All the other columns put together in parentheses and separated by commas
-            df.loc[:, other_columns]
-              .astype(str)
-              .agg(lambda values: f'({",".join(values)})', axis=1)
-            ], axis=1)
-            .agg(','.join, axis=1)
-        )
-
-        return '\n'.join([self.prefix,
-                          self.column_definitions,
-                          *data.to_list()])
+        if 'pho' not in df.columns:
+            raise ValueError(f'There is no pho field in {self.opf_file.path}, add it first')
+        if not pho_by_id.index.is_unique:
+            raise ValueError('Multiple pho values for the same id')
+        ids_to_drop = pd.Index(ids_to_drop)
+        # Same as for .drop - we don't want to silently skip ids that aren't there
+        for ids in (pho_by_id.index, ids_to_drop):
+            missing = ids.difference(df.id)
+            if len(missing) > 0:
+                raise KeyError(f'Ids not found in {self.opf_file.path}: {missing.to_list()}')
+
+        # update the pho field
+        is_target = df.id.isin(pho_by_id.index)
+        df.loc[is_target, 'pho'] = df.loc[is_target, 'id'].map(pho_by_id)
+        self.mark_modified()
+
+        # drop the pho cells
+        self._drop_rows(df.id.isin(ids_to_drop))
+
+    def find_phos_after_comments(self, comment_prefixes=COMMENT_PREFIXES_WITH_PHO):
+        """
+        Finds the pho cells that follow a comment cell, e.g., '%com: mwu ...', the transcription in such a cell belongs
+        to the comment cell.
+        :param comment_prefixes: the object prefixes of the comment cells
+        :return: (pho_by_id, ids_to_drop) for move_pho
+        """
+        objects = self.df.object.astype(object)
+        is_pho = objects.str.contains(PHO_PREFIX).fillna(False).astype(bool)
+        follows_comment = objects.shift(1).str.startswith(tuple(comment_prefixes)).fillna(False).astype(bool)
+        is_moved = is_pho & follows_comment
+        # The comment cells are the ones right before the moved pho cells
+        is_target = is_moved.shift(-1, fill_value=False).astype(bool)
+
+        pho_by_id = pd.Series(objects[is_moved].to_numpy(), index=self.df.id[is_target].to_numpy(), name='pho')
+        ids_to_drop = self.df.id[is_moved].to_list()
+        return pho_by_id, ids_to_drop
+
+    def _drop_rows(self, to_drop: pd.Series):
+        """
+        Drops rows and resets the index, keeping the serialized cells aligned.
+        :param to_drop: boolean mask aligned with self.df
+        """
+        keep = ~to_drop.to_numpy()
+        if self._serialized_cells is not None and self.df.index.is_unique:
+            # Rows added since the last write become NaN and are serialized on the next one
+            self._serialized_cells = self._serialized_cells.reindex(self.df.index)[keep].reset_index(drop=True)
+            self._serialized_hashes = self._serialized_hashes.reindex(self.df.index)[keep].reset_index(drop=True)
+        else:
+            self._serialized_cells = self._serialized_hashes = None
+        self.df = self.df[keep].reset_index(drop=True)
+        self._modified = True
 
     def can_be_reversed(self):
         """
         Can we reconstruct the db in the original file up to an empty line at the end?
+        Without any changes, that was checked when the file was parsed. Otherwise, the dataframe is serialized (the
+        cells are cached for the next write) and compared to the original by its digest.
         :return:
         """
-        return str(self) == self.opf_file.db.rstrip()
+        if not self.is_modified():
+            return self.reversible
+        return self._digest(str(self)) == self.db_digest
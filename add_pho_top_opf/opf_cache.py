@@ -0,0 +1,116 @@
+import json
+import hashlib
+from pathlib import Path
+from zipfile import ZipFile, BadZipFile
+
+import pandas as pd
+
+
+class OPFCache(object):
+    """
+    Persistent cache of parsed OPF databases.
+
+    Each OPFDataFrame is stored as a Parquet file with the columns of its dataframe and a json sidecar with the rest:
+    the attributes of OPFDataFrame (prefix, column definitions, etc.) and the key the entry was created with. The key
+    consists of the archive path, its mtime and size, and the size and the CRC of the "db" entry in the archive - taken
+    from the zip central directory, so checking an entry doesn't decompress anything. For unzipped opf files, the mtime
+    and size of "db" are used instead of its CRC. If any of these change, the entry is considered stale and is deleted.
+
+    Writing Parquet files requires pyarrow (or fastparquet) to be installed.
+    """
+    def __init__(self, cache_dir: Path):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(path: Path):
+        """
+        Key identifying the version of the opf file the cached dataframe was created from.
+        :param path: path to the .opf file or to the folder with its unzipped contents
+        :return: dict or None if the file can't be read
+        """
+        path = Path(path)
+        try:
+            stat = path.stat()
+            key = dict(path=str(path.absolute()), mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+            if path.is_dir():
+                # The mtime of the folder doesn't change when db is overwritten in place
+                db_stat = (path / 'db').stat()
+                key.update(db_mtime_ns=db_stat.st_mtime_ns, db_size=db_stat.st_size)
+            else:
+                with ZipFile(path, 'r') as opf_zipped:
+                    db_info = opf_zipped.getinfo('db')
+                key.update(db_size=db_info.file_size, db_crc=db_info.CRC)
+        except (OSError, KeyError, BadZipFile):
+            # Missing, not an opf file, etc. - let whoever parses it report that
+            return None
+        return key
+
+    def _entry_paths(self, path):
+        name = hashlib.sha1(str(Path(path).absolute()).encode('utf-8')).hexdigest()
+        return self.cache_dir / f'{name}.parquet', self.cache_dir / f'{name}.json'
+
+    def _fresh_meta(self, path):
+        """
+        :return: the sidecar contents if the entry is up-to-date, None otherwise. Stale entries are deleted.
+        """
+        parquet_path, meta_path = self._entry_paths(path)
+        if not (parquet_path.exists() and meta_path.exists()):
+            return None
+
+        with meta_path.open('r', encoding='utf-8') as f:
+            meta = json.load(f)
+
+        # Entries written by an older version of the code don't have all the attributes
+        key = self.key(path)
+        if key is None or meta['key'] != key or 'attributes' not in meta:
+            self.invalidate(path)
+            return None
+        return meta
+
+    def is_fresh(self, path: Path):
+        """
+        Checks whether there is an up-to-date entry without reading the dataframe or decompressing the opf file.
+        """
+        return self._fresh_meta(path) is not None
+
+    def get(self, path: Path):
+        """
+        Reads the cached version of the parsed db if it is up-to-date.
+        :param path: path to the .opf file or to the folder with its unzipped contents
+        :return: (attributes, df) or None if there is no up-to-date entry
+        """
+        meta = self._fresh_meta(path)
+        if meta is None:
+            return None
+        parquet_path, _ = self._entry_paths(path)
+        df = pd.read_parquet(parquet_path)
+        # Parquet stores column names as strings which is what we have anyway but the order needs to be checked
+        assert df.columns.to_list() == meta['columns']
+
+        return meta['attributes'], df
+
+    def put(self, path: Path, df: pd.DataFrame, key=None, **attributes):
+        """
+        :param path: path to the .opf file or to the folder with its unzipped contents
+        :param df: parsed dataframe
+        :param key: output of key() taken before the file was read, so that a change made while it was being parsed
+        makes the entry stale. Taken now if None.
+        :param attributes: json-serializable values to store with the dataframe, e.g., prefix and column_definitions
+        """
+        key = key or self.key(path)
+        if key is None:
+            return
+        parquet_path, meta_path = self._entry_paths(path)
+        df.to_parquet(parquet_path, index=False)
+        meta = dict(key=key,
+                    attributes=attributes,
+                    columns=df.columns.to_list())
+        # Write the sidecar last - an entry without one is never read
+        with meta_path.open('w', encoding='utf-8') as f:
+            json.dump(meta, f)
+
+    def invalidate(self, path: Path):
+        for entry_path in self._entry_paths(path):
+            if entry_path.exists():
+                entry_path.unlink()
@@ -0,0 +1,79 @@
+import pandas as pd
+
+from opf import OPFFile, OPFDataFrame, COMMENT_PREFIXES_WITH_PHO
+from opf_operations import record_move_pho
+
+
+class OPFCorpus(object):
+    """
+    A collection of OPFDataFrame objects indexed by the path of their opf files.
+    """
+    def __init__(self, opf_dfs):
+        self._by_path = dict()
+        for opf_df in opf_dfs:
+            path = opf_df.opf_file.path
+            if path in self._by_path:
+                raise ValueError(f'Multiple dataframes for {path}')
+            self._by_path[path] = opf_df
+
+    @classmethod
+    def from_paths(cls, paths, cache=None):
+        return cls(OPFDataFrame(OPFFile(path, lazy=True), cache=cache) for path in paths)
+
+    @property
+    def paths(self):
+        return list(self._by_path)
+
+    def __getitem__(self, path):
+        return self._by_path[path]
+
+    def __contains__(self, path):
+        return path in self._by_path
+
+    def __iter__(self):
+        return iter(self._by_path.values())
+
+    def __len__(self):
+        return len(self._by_path)
+
+    def move_pho(self, chis_with_phos: pd.DataFrame, operation_log=None):
+        """
+        Moves transcriptions from the pho cells to the pho field of the corresponding CHI cells and drops the pho cells.
+        :param chis_with_phos: rows from the output of collect_all_chi for all the files, with the file_path column.
+        Each row should have the CHI cell id in "id", the pho cell id in "id_pho" and the transcription in
+        "object_pho".
+        :param operation_log: optional operation_log.OperationLog object to record the changes to
+        :return: list of the updated OPFDataFrame objects
+        """
+        updated = list()
+        for path, sub_df in chis_with_phos.groupby('file_path'):
+            opf_df = self[path]
+            pho_by_id, ids_to_drop = sub_df.set_index('id').object_pho, sub_df.id_pho
+            opf_df.move_pho(pho_by_id=pho_by_id, ids_to_drop=ids_to_drop)
+            if operation_log is not None:
+                record_move_pho(operation_log, path, pho_by_id=pho_by_id, ids_to_drop=ids_to_drop,
+                                column=opf_df.column_name)
+            updated.append(opf_df)
+
+        return updated
+
+    def move_phos_after_comments(self, comment_prefixes=COMMENT_PREFIXES_WITH_PHO, operation_log=None):
+        """
+        Moves transcriptions from the pho cells that follow comment cells (first words, multi-word utterances) to the
+        pho field of these comment cells and drops the pho cells, in all the files.
+        :param comment_prefixes: see OPFDataFrame.find_phos_after_comments
+        :param operation_log: optional operation_log.OperationLog object to record the changes to
+        :return: list of the updated OPFDataFrame objects
+        """
+        updated = list()
+        for path, opf_df in self._by_path.items():
+            pho_by_id, ids_to_drop = opf_df.find_phos_after_comments(comment_prefixes)
+            if not ids_to_drop:
+                continue
+            opf_df.move_pho(pho_by_id=pho_by_id, ids_to_drop=ids_to_drop)
+            if operation_log is not None:
+                record_move_pho(operation_log, path, pho_by_id=pho_by_id, ids_to_drop=ids_to_drop,
+                                column=opf_df.column_name)
+            updated.append(opf_df)
+
+        return updated
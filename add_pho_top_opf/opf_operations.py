@@ -0,0 +1,202 @@
+"""
+Operations on the opf files recorded in operation_log.OperationLog and the function that applies them.
+
+The operations are applied to the lines of "db" directly, without building a dataframe. Cells are looked up by their
+id, so the operations can be applied to a file that has already been changed by some of them, e.g., to the backup copy
+after the original file has been updated, or twice in a row.
+
+    opf.add_field(column, name, field_type, value) - adds a field with the same value in all the cells, if not there yet
+    opf.set_field(column, id, field, value) - sets the value of a field in the cell with this id
+    opf.drop_cell(column, id) - drops the cell with this id
+
+column is the name of the datavyu column the change was made to. Operations recorded without it (older logs) are
+applied to the first column.
+
+A cell that isn't there is an error, except when the operations being applied drop it themselves: dropping a cell that
+is already gone and setting a field of a cell that is dropped anyway change nothing. A cell id found in another
+column is always an error.
+"""
+from collections import defaultdict
+
+from opf import OPFFile, field_names_of, column_name_of, cell_to_values, values_to_cell, is_column_definition
+
+
+ADD_FIELD = 'opf.add_field'
+SET_FIELD = 'opf.set_field'
+DROP_CELL = 'opf.drop_cell'
+
+
+def record_add_field(log, path, name, value='', field_type='NOMINAL', column=None):
+    """
+    :param column: name of the datavyu column, e.g., OPFDataFrame.column_name
+    """
+    log.append(ADD_FIELD, path, column=column, name=name, field_type=field_type, value=value)
+
+
+def record_move_pho(log, path, pho_by_id, ids_to_drop, column=None):
+    """
+    Records the operations OPFDataFrame.move_pho makes, with the same arguments.
+    :param column: name of the datavyu column, e.g., OPFDataFrame.column_name
+    """
+    for id_, pho in pho_by_id.items():
+        log.append(SET_FIELD, path, column=column, id=id_, field='pho', value=pho)
+    for id_ in ids_to_drop:
+        log.append(DROP_CELL, path, column=column, id=id_)
+
+
+class DBColumn(object):
+    """
+    The cells of one datavyu column in DBLines.
+    """
+    def __init__(self, db_lines, definition_line_number, end):
+        """
+        :param db_lines: DBLines object the column is in
+        :param definition_line_number: number of the line with the column definition
+        :param end: number of the line after the last cell of the column
+        """
+        self.db_lines = db_lines
+        self.definition_line_number = definition_line_number
+        self.name = column_name_of(db_lines.lines[definition_line_number])
+        self.field_names = field_names_of(db_lines.lines[definition_line_number])
+        self.end = end
+        self._line_number_by_id = None
+
+    def _cell_line_numbers(self):
+        lines, dropped = self.db_lines.lines, self.db_lines.dropped
+        return [i for i in range(self.definition_line_number + 1, self.end) if lines[i].strip() and i not in dropped]
+
+    def values_of(self, line_number):
+        return self.db_lines.values_of(line_number, n_fields=len(self.field_names))
+
+    def line_number_of(self, id_):
+        if self._line_number_by_id is None:
+            self._line_number_by_id = dict()
+            if 'id' in self.field_names:
+                id_position = self.field_names.index('id')
+                for i in self._cell_line_numbers():
+                    cell_id = self.values_of(i)[id_position]
+                    if cell_id in self._line_number_by_id:
+                        raise ValueError(f'Multiple cells with id {cell_id}')
+                    self._line_number_by_id[cell_id] = i
+        return self._line_number_by_id.get(id_)
+
+    def add_field(self, name, value, field_type):
+        if name in self.field_names:
+            return False
+        for i in self._cell_line_numbers():
+            self.values_of(i).append(value)
+            self.db_lines.modified.add(i)
+        self.db_lines.lines[self.definition_line_number] += f',{name}|{field_type}'
+        self.field_names.append(name)
+        return True
+
+    def set_field(self, id_, field, value):
+        line_number = self.line_number_of(id_)
+        if line_number is None:
+            return False
+        if field not in self.field_names:
+            raise KeyError(f'There is no field {field} in column {self.name}')
+        values = self.values_of(line_number)
+        position = self.field_names.index(field)
+        if values[position] == value:
+            return False
+        values[position] = value
+        self.db_lines.modified.add(line_number)
+        return True
+
+    def drop_cell(self, id_):
+        line_number = self.line_number_of(id_)
+        if line_number is None:
+            return False
+        self.db_lines.dropped.add(line_number)
+        del self._line_number_by_id[id_]
+        return True
+
+
+class DBLines(object):
+    """
+    The lines of "db" with the cells split into values only when they are needed.
+    """
+    def __init__(self, db):
+        self.lines = db.split('\n')
+        self.values = dict()
+        # Only the modified cells are converted back to text, the rest are written as they were
+        self.modified = set()
+        self.dropped = set()
+        # The cells of each column end where the next column is defined
+        starts = [i for i in range(1, len(self.lines)) if is_column_definition(self.lines[i])]
+        self.columns = [DBColumn(self, start, end) for start, end in zip(starts, starts[1:] + [len(self.lines)])]
+
+    def column(self, name=None):
+        """
+        :param name: name of the datavyu column, the first column if None
+        :return: DBColumn
+        """
+        if name is None:
+            return self.columns[0]
+        for column in self.columns:
+            if column.name == name:
+                return column
+        raise KeyError(f'There is no column {name}')
+
+    def values_of(self, line_number, n_fields):
+        if line_number not in self.values:
+            self.values[line_number] = cell_to_values(self.lines[line_number], n_fields=n_fields)
+        return self.values[line_number]
+
+    def __str__(self):
+        return '\n'.join(values_to_cell(self.values[i]) if i in self.modified else line
+                          for i, line in enumerate(self.lines)
+                          if i not in self.dropped)
+
+
+def _check_found(db_lines, column, id_, operation, dropped_ids):
+    """
+    Raises KeyError if a cell the operation is for can't be found, see the module docstring.
+    """
+    others = [other.name for other in db_lines.columns if other is not column and other.line_number_of(id_) is not None]
+    if others:
+        raise KeyError(f'{operation.name}: cell {id_} is in column {others[0]}, not in {column.name}')
+    if id_ not in dropped_ids:
+        raise KeyError(f'{operation.name}: there is no cell {id_} in column {column.name} of {operation.path}')
+
+
+def apply_operations(path, operations):
+    """
+    Applies the operations to an opf file and overwrites it if anything changed.
+    :param path: path to the .opf file or to the folder with its unzipped contents
+    :param operations: list of operation_log.Operation objects
+    :return: bool - whether the file has changed
+    """
+    opf_file = OPFFile(path)
+    db_lines = DBLines(opf_file.db)
+    # Cells that may already be gone, see the module docstring
+    dropped_ids = defaultdict(set)
+    for operation in operations:
+        if operation.name == DROP_CELL:
+            dropped_ids[operation.arguments.get('column')].add(operation.arguments['id'])
+
+    for operation in operations:
+        arguments = operation.arguments
+        column = db_lines.column(arguments.get('column'))
+        if operation.name == ADD_FIELD:
+            column.add_field(arguments['name'], arguments['value'], arguments['field_type'])
+        elif operation.name in (SET_FIELD, DROP_CELL):
+            id_ = arguments['id']
+            if column.line_number_of(id_) is None:
+                _check_found(db_lines, column, id_, operation, dropped_ids[arguments.get('column')])
+                continue
+            if operation.name == SET_FIELD:
+                column.set_field(id_, arguments['field'], arguments['value'])
+            else:
+                column.drop_cell(id_)
+        else:
+            raise ValueError(f'Unknown operation: {operation.name}')
+
+    # Later operations can undo the earlier ones, so we compare the end result instead of counting the changes
+    db = str(db_lines)
+    if db == opf_file.db:
+        return False
+    opf_file.db = db
+    opf_file.write(overwrite_original=True, unzipped=path.is_dir())
+    return True
@@ -0,0 +1,213 @@
+"""
+Opt-in profiling of the OPF pipeline stages.
+
+The stages in OPFFile, OPFDataFrame, and opf_reports are wrapped in stage(). While profiling is off, that is a check of
+one global and nothing is recorded. Once enabled, every stage records its wall time, the file it worked on, the bytes
+and the cells it went through, and - if memory tracing is on - the tracemalloc high-water mark above what was
+allocated when the stage started. Stages can be nested, each one reports its own peak.
+
+Example:
+    profiler = opf_profiling.enable()
+    ...
+    opf_profiling.disable()
+    profiler.write_report(reports_dir / 'profile')  # profile.json with the totals by stage, profile.csv with all the
+                                                    # records
+
+Only the stages run in this process are recorded, e.g., not the ones in the opf_writer worker processes. Stages run in
+worker threads, e.g., by opf_sync.sync_to_backup, are recorded without peak_bytes: tracemalloc has one peak for the
+whole process, so it is only attributed to the stages of the main thread. Allocations made by worker threads at the same
+time still count towards those.
+"""
+import json
+import functools
+import threading
+import time
+import tracemalloc
+from collections import namedtuple
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+
+import pandas as pd
+
+
+StageRecord = namedtuple('StageRecord', ['stage', 'file_path', 'seconds', 'bytes', 'cells', 'peak_bytes'])
+RECORD_COLUMNS = StageRecord._fields
+
+# The profiler in use, None if profiling is off
+_profiler = None
+
+
+class _Measurement(object):
+    """
+    What the code inside a stage can tell about its work
+    """
+    def __init__(self, file_path=None):
+        self.file_path = file_path
+        self.bytes = None
+        self.cells = None
+
+    def set(self, bytes=None, cells=None):
+        if callable(bytes):
+            bytes = bytes()
+        if callable(cells):
+            cells = cells()
+        if bytes is not None:
+            self.bytes = bytes
+        if cells is not None:
+            self.cells = cells
+
+
+class _NotMeasured(object):
+    def set(self, bytes=None, cells=None):
+        pass
+
+
+# Reusable, so that nothing is allocated when profiling is off
+_NOT_PROFILED = nullcontext(_NotMeasured())
+
+
+class Profiler(object):
+    def __init__(self, trace_memory=True):
+        """
+        :param trace_memory: measure the peak memory with tracemalloc. It makes python allocations a few times slower,
+        so the wall times are less accurate with it on.
+        """
+        self.trace_memory = trace_memory
+        self.records = list()
+        # Absolute tracemalloc peaks of the main thread stages in progress, the innermost one last
+        self._peaks = list()
+        self._started_tracemalloc = False
+
+    def start(self):
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+
+    def stop(self):
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+
+    def _peak_so_far(self):
+        # tracemalloc has one peak for everything. Before resetting it, we hand it over to the enclosing stage.
+        _, peak = tracemalloc.get_traced_memory()
+        if self._peaks:
+            self._peaks[-1] = max(self._peaks[-1], peak)
+        tracemalloc.reset_peak()
+
+    @contextmanager
+    def stage(self, name, file_path=None):
+        measurement = _Measurement(file_path)
+        tracing = (self.trace_memory and tracemalloc.is_tracing()
+                   and threading.current_thread() is threading.main_thread())
+        if tracing:
+            self._peak_so_far()
+            start_memory, _ = tracemalloc.get_traced_memory()
+            self._peaks.append(start_memory)
+        start = time.perf_counter()
+        try:
+            yield measurement
+        finally:
+            seconds = time.perf_counter() - start
+            peak_bytes = None
+            if tracing:
+                self._peak_so_far()
+                peak = self._peaks.pop()
+                peak_bytes = peak - start_memory
+                if self._peaks:
+                    self._peaks[-1] = max(self._peaks[-1], peak)
+            self.records.append(StageRecord(
+                stage=name, file_path=None if measurement.file_path is None else str(measurement.file_path),
+                seconds=seconds, bytes=measurement.bytes, cells=measurement.cells, peak_bytes=peak_bytes))
+
+    def to_df(self):
+        df = pd.DataFrame(columns=RECORD_COLUMNS, data=self.records)
+        # Not measured is None, not NaN
+        return df.astype(dict(bytes='Int64', cells='Int64', peak_bytes='Int64'))
+
+    def summary(self):
+        """
+        :return: dataframe with one row per stage: number of calls, total seconds, bytes, and cells, the largest peak,
+        and the file with the largest peak
+        """
+        df = self.to_df()
+        if len(df) == 0:
+            return pd.DataFrame(columns=['stage', 'calls', 'seconds', 'bytes', 'cells', 'peak_bytes', 'peak_file_path'])
+        by_stage = df.groupby('stage', sort=False)
+        summary = pd.DataFrame({
+            'calls': by_stage.size(),
+            'seconds': by_stage.seconds.sum(),
+            'bytes': by_stage['bytes'].sum(min_count=1),
+            'cells': by_stage.cells.sum(min_count=1),
+            'peak_bytes': by_stage.peak_bytes.max()})
+        peaks = df.dropna(subset=['peak_bytes'])
+        summary['peak_file_path'] = (peaks.loc[peaks.groupby('stage', sort=False).peak_bytes.idxmax()]
+                                     .set_index('stage').file_path) if len(peaks) > 0 else None
+        return summary.reset_index()
+
+    def write_report(self, path: Path):
+        """
+        Writes <path>.json with the summary by stage and <path>.csv with all the records.
+        :param path: path without the extension
+        :return: (json path, csv path)
+        """
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        json_path, csv_path = path.with_name(path.name + '.json'), path.with_name(path.name + '.csv')
+        self.to_df().to_csv(csv_path, index=False)
+        summary = self.summary().astype(object).where(lambda df: df.notna(), None)
+        with json_path.open('w', encoding='utf-8') as f:
+            json.dump(dict(trace_memory=self.trace_memory, stages=summary.to_dict(orient='records')), f, indent=1)
+        return json_path, csv_path
+
+
+def enable(trace_memory=True):
+    """
+    Starts recording the stages.
+    :return: the Profiler object the records go to
+    """
+    global _profiler
+    disable()
+    _profiler = Profiler(trace_memory=trace_memory)
+    _profiler.start()
+    return _profiler
+
+
+def disable():
+    global _profiler
+    if _profiler is not None:
+        _profiler.stop()
+    _profiler = None
+
+
+def stage(name, file_path=None):
+    """
+    Context manager around a stage. Yields an object whose set(bytes=..., cells=...) records the amount of work done.
+    The values can be functions that compute them, those are only called if profiling is on.
+    :param name: stage name, e.g., 'parse'
+    :param file_path: path of the file the stage works on, if any
+    """
+    if _profiler is None:
+        return _NOT_PROFILED
+    return _profiler.stage(name, file_path=file_path)
+
+
+def profiled(name, file_path_of=None, cells_of=None):
+    """
+    Decorator that runs the function as a stage.
+    :param name: stage name
+    :param file_path_of: optional function that takes the arguments of the call and returns the file path
+    :param cells_of: optional function that takes the arguments of the call and returns the number of cells
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _profiler is None:
+                return function(*args, **kwargs)
+            file_path = file_path_of(*args, **kwargs) if file_path_of else None
+            with _profiler.stage(name, file_path=file_path) as measurement:
+                if cells_of:
+                    measurement.set(cells=cells_of(*args, **kwargs))
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,257 @@
+from pathlib import Path
+from collections import namedtuple
+
+import pandas as pd
+
+from opf import OPFDataFrame, DATETIME_FORMAT, PHO_PREFIX, milliseconds_to_times
+from opf_profiling import profiled
+
+
+STRPTIME_EPOCH = pd.Timestamp('1900-01-01')
+
+
+@profiled('collect_all_chi', file_path_of=lambda opf: opf.opf_file.path, cells_of=lambda opf: len(opf.df))
+def collect_all_chi(opf: OPFDataFrame):
+    """
+    Finds all CHI and %pho cells and establishes their correspondence.
+    :param opf: OPFDataFrame object
+    :return: opf.df with only the CHI rows and with additional columns corresponding to the pho cell.
+    """
+    df: pd.DataFrame = opf.df.copy()
+
+    # For the fuzzy merging (time_end of CHI and %pho being approximately equal), we will need time_end to be a numeric
+    # (datetime in this case) column and sorted.
+    # Compacted dataframes store time as milliseconds. The output has to be the same as without compaction: time_start
+    # as text and time_end as datetimes on 1900-01-01 - the date strptime uses.
+    if pd.api.types.is_integer_dtype(df.time_start):
+        df['time_start'] = milliseconds_to_times(df.time_start)
+    if pd.api.types.is_integer_dtype(df.time_end):
+        df['time_end'] = STRPTIME_EPOCH + pd.to_timedelta(df.time_end, unit='ms')
+    else:
+        df['time_end'] = pd.to_datetime(df.time_end, format=DATETIME_FORMAT)
+    df.sort_values(by='time_end', inplace=True)
+
+    # Find child utterance and pho cells
+    is_chi = df.speaker == 'CHI'
+    is_pho = df.object.str.contains(PHO_PREFIX)
+
+    # We will only need some columns from the pho cells: time_start, time_end, annotid and object. The other ones should
+    # be empty ('NA' for original columns, '' for the 'pho' column). The exception is that sometimes the speaker field
+    # value is 'NA\, NEW' or 'NEW' - we can disregard this information.
+    columns_to_keep = ['object', 'id', 'time_start', 'time_end']
+    assert df[is_pho].drop(columns_to_keep, axis='columns').isin(['NA', '', 'NA\\, NEW', 'NEW']).all().all()
+
+    # # Merge
+    chis_with_phos = pd.merge_asof(
+        df[is_chi],
+        # rename time_end to keep both times for approximate matches
+        df[is_pho][columns_to_keep].rename(columns={'time_end': 'time_end_pho'}),
+        left_on='time_end',
+        right_on='time_end_pho',
+        suffixes=('', '_pho'),
+        direction='nearest',
+        tolerance=pd.Timedelta('0.5s'))
+
+    # Add orphan %pho's - if any - by merging with all the pho's on annotid.
+    # By merging on all the pho columns, we won't add any new columns.
+    # If multiple CHI cells were found to correspond to a single pho cell, this will result in duplicate columns. Same
+    # will happen if there identical pho rows.
+    pho_columns = [column + '_pho' for column in columns_to_keep]
+    chis_with_phos = chis_with_phos.merge(
+        df[is_pho][columns_to_keep].rename(columns=dict(zip(columns_to_keep, pho_columns))),
+        on=pho_columns,
+        how='outer'
+    )
+
+    return chis_with_phos
+
+
+# These column combinations are supposed to be unique
+UNIQUE_CHI_COLUMNS = ['file_path', 'id', 'time_start', 'time_end']
+UNIQUE_PHO_COLUMNS = ['file_path', 'id_pho', 'time_start_pho', 'time_end_pho']
+
+FLAG_COLUMNS = ['is_pho_cell', 'is_pho_cell_filled', 'is_pho_field', 'is_pho_field_filled']
+
+REPORT_FILENAMES = dict(orphans='orphan_phos.csv',
+                        duplicates='duplicates.csv',
+                        inconsistent_ones='inconsistent_ones.csv',
+                        summary='summary.csv')
+
+
+def _strip_pho_prefix(values: pd.Series):
+    """
+    Removes PHO_PREFIX, applying the regex to the column just once.
+    :return: (stripped values, whether the prefix was there) - both NaN-preserving
+    """
+    stripped = values.str.replace(PHO_PREFIX, '', regex=True)
+    # The prefix is never empty so the value changes if and only if the prefix was found
+    has_prefix = (stripped != values).where(values.notna())
+    return stripped, has_prefix
+
+
+def transcriptions_by_id(opf: OPFDataFrame, speaker='CHI'):
+    """
+    Maps ids of the speaker's cells to the transcriptions in their pho fields, without the "%pho: " prefix.
+    :param opf: OPFDataFrame object
+    :param speaker: speaker code
+    :return: dict, cells with an empty or no pho field are mapped to None
+    """
+    df = opf.df[opf.df.speaker == speaker]
+    if 'pho' not in df.columns:
+        return dict.fromkeys(df.id)
+    transcriptions, _ = _strip_pho_prefix(df.pho.astype(object))
+    transcriptions = transcriptions.str.strip()
+    return dict(zip(df.id, transcriptions.where(transcriptions.str.len() > 0, None)))
+
+
+# Classify based on pho field/cell presence and the transcription actually being there
+@profiled('add_flags', cells_of=len)
+def add_flags(chis_with_phos):
+    """
+    Adds binary columns 'is_pho_cell', 'is_pho_cell_filled', 'is_pho_field', 'is_pho_field_filled'
+    :param chis_with_phos: output of collect_all_chi
+    :return: chis_with_phos with four additional columns.
+    """
+    # Is there a pho cell?
+    chis_with_phos['is_pho_cell'] = ~chis_with_phos.object_pho.isna()
+
+    # Does it have anything in it?
+    object_pho_stripped, has_prefix = _strip_pho_prefix(chis_with_phos.object_pho)
+    # First, check that they all have the same prefix "%pho: " (NaNs are for the rows without a pho cell)
+    assert has_prefix.dropna().all()
+    # Is there at least one character after the prefix?
+    chis_with_phos['is_pho_cell_filled'] = (
+        (object_pho_stripped.str.len() > 0)
+        # We want NaN, not False when there was no pho cell
+        .where(chis_with_phos.is_pho_cell))
+
+    # Is there a pho field?
+    # If there was, and it was empty, then it would equal to '' now; if there wasn't, it would now be NaN.
+    chis_with_phos['is_pho_field'] = ~chis_with_phos.pho.isna()
+
+    # Does it have anything in it?
+    pho_stripped, _ = _strip_pho_prefix(chis_with_phos.pho)
+    # Is there at least one character after the prefix?
+    chis_with_phos['is_pho_field_filled'] = (
+        (pho_stripped.str.len() > 0)
+        # We want NaN, not False when there was no pho field
+        .where(chis_with_phos.is_pho_field))
+
+    return chis_with_phos
+
+
+# Make summary tables
+def make_pivot(chis):
+    return (chis
+            .groupby(FLAG_COLUMNS, dropna=False)
+            .size()
+            .to_frame('size')
+            .reset_index())
+
+
+OPFReports = namedtuple('OPFReports', ['full', 'is_odd', 'orphans', 'duplicates', 'inconsistent_ones', 'summary'])
+
+
+def build_reports(all_chis_with_phos: pd.DataFrame, output_dir: Path = None):
+    """
+    Computes the flags and all the reports in one go:
+    - orphans: %pho cells without a CHI cell,
+    - duplicates: CHI cells matched to multiple %pho cells and vice versa,
+    - inconsistent_ones: annotations that have both the pho cell and the pho field filled,
+    - summary: make_pivot of all the rows and of the rows that are not odd, i.e., not in any of the above (with the
+      exception of the duplicates that are not really duplicates, see below).
+    :param all_chis_with_phos: outputs of collect_all_chi for all the files concatenated, with the file_path column
+    :param output_dir: if supplied, the reports are written there as csv files, see REPORT_FILENAMES
+    :return: OPFReports, "full" is all_chis_with_phos with the flag columns added
+    """
+    original_columns = all_chis_with_phos.columns.to_list()
+    full = add_flags(all_chis_with_phos)
+
+    # Report memberships, all computed from the same table
+    is_orphan = full.object.isna()
+    # Don't count empty rows as duplicates of each other
+    is_chi_duplicate = full.duplicated(subset=UNIQUE_CHI_COLUMNS, keep=False) & ~is_orphan
+    is_pho_duplicate = full.duplicated(subset=UNIQUE_PHO_COLUMNS, keep=False) & ~full.object_pho.isna()
+    is_inconsistent = (full.is_pho_cell_filled == True) & (full.is_pho_field_filled == True)  # noqa: E712 (NaNs)
+
+    # # Orphan phos
+    orphans = full.loc[is_orphan, ['file_path', 'object_pho', 'id_pho', 'time_start_pho', 'time_end_pho']]
+    # A random date was added to time for technical reasons, we don't need it anymore
+    orphans = orphans.assign(time_end_pho=orphans.time_end_pho.dt.time)
+
+    # # Non-unique ids (not one-to-one matches)
+    duplicates = pd.concat(
+        objs=[full.loc[is_chi_duplicate, original_columns],
+              full.loc[is_pho_duplicate, original_columns]],
+        keys=['CHIs sharing a %pho', '%phos sharing a CHI'],
+        names=['duplicate_type', 'index']
+    ).reset_index(0)
+
+    # # Inconsistent transcriptions
+    inconsistent_ones = full[is_inconsistent]
+
+    # # Odd ones
+    # Everything with the same CHI id within a file as a duplicated or an inconsistent row is odd as well.
+    # The exception are the duplicates that are not really duplicates, they are just two utterance and then one pho
+    # cell. The timestamp of the pho cell corresponds exactly to the timestamp of the second CHI cell.
+    is_duplicate = is_chi_duplicate | is_pho_duplicate
+    by_chi_id = (pd.DataFrame(dict(marked=is_duplicate | is_inconsistent,
+                                   not_really_duplicate=is_duplicate & (full.time_end == full.time_end_pho)))
+                 .groupby([full.file_path, full.id], dropna=False, sort=False)
+                 .transform('any'))
+    is_odd = (is_orphan | by_chi_id.marked) & ~by_chi_id.not_really_duplicate
+
+    # # Summary
+    summary = pd.concat(
+        objs=[make_pivot(full), make_pivot(full[~is_odd])],
+        keys=['all', 'not odd'],
+        names=['subset', 'index']
+    ).reset_index(0)
+
+    reports = OPFReports(full=full, is_odd=is_odd, orphans=orphans, duplicates=duplicates,
+                         inconsistent_ones=inconsistent_ones, summary=summary)
+    if output_dir is not None:
+        write_reports(reports, output_dir)
+    return reports
+
+
+def combine_reports(reports_list):
+    """
+    Puts together the reports built for separate sets of files, e.g., for each file on its own so that only the
+    changed files need to be processed again. The result is the same as that of build_reports for all the files: the
+    rows of every report except for the summary only depend on the rows of the same file, the summary counts add up.
+    :param reports_list: OPFReports objects in the order of the files
+    :return: OPFReports
+    """
+    def concat(name):
+        return pd.concat([getattr(reports, name) for reports in reports_list])
+
+    # build_reports lists all the CHI duplicates first, then all the pho ones
+    duplicates = concat('duplicates')
+    duplicates = pd.concat([duplicates[duplicates.duplicate_type == duplicate_type]
+                            for duplicate_type in duplicates.duplicate_type.unique()])
+
+    summary = (concat('summary')
+               .groupby(['subset', *FLAG_COLUMNS], dropna=False)['size'].sum()
+               .reset_index())
+    summary.index = summary.groupby('subset').cumcount().rename('index')
+
+    return OPFReports(full=concat('full'), is_odd=concat('is_odd'), orphans=concat('orphans'), duplicates=duplicates,
+                      inconsistent_ones=concat('inconsistent_ones'), summary=summary)
+
+
+def _write_csv(df, path: Path):
+    # Same as watch.write_table, the opf modules don't import the ones at the root of the repo
+    temp_path = path.with_name(f'.{path.name}.tmp')
+    df.to_csv(temp_path, index=False)
+    temp_path.replace(path)
+
+
+def write_reports(reports: OPFReports, output_dir: Path):
+    """
+    Writes the reports as csv files, see REPORT_FILENAMES. Each file is replaced at once, so it is never seen
+    half-written, e.g., while the watch mode rewrites it.
+    """
+    output_dir.mkdir(parents=True, exist_ok=True)
+    for name, filename in REPORT_FILENAMES.items():
+        _write_csv(getattr(reports, name), output_dir / filename)
@@ -0,0 +1,121 @@
+import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from zipfile import ZipFile
+
+from opf import OPFFile
+
+
+def backup_path_for(opf_path: Path, backup_dir: Path):
+    """
+    Where the unzipped copy of an opf file lives in the backup repo
+    """
+    return backup_dir / opf_path.stem
+
+
+def _crc32(path: Path):
+    crc = 0
+    with path.open('rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+
+def _members(opf_path: Path):
+    """
+    :return: ZipInfo objects of the files in the archive, without the macos-specific ones
+    """
+    with ZipFile(opf_path, 'r') as opf_zipped:
+        return [info for info in opf_zipped.infolist()
+                if not info.is_dir()
+                and not any(info.filename.startswith(prefix) for prefix in OPFFile.SKIP_PREFIXES)]
+
+
+def is_backup_up_to_date(opf_path: Path, backup_path: Path):
+    """
+    Compares the members of an opf archive to the files in its unzipped backup. Sizes and CRCs of the archive members
+    are taken from the zip metadata so nothing is decompressed. The backup files are stamped with the mtime of the
+    archive they were copied from, see _sync_one, so only the ones with a different mtime are read to compute their
+    CRCs.
+    :param opf_path: path to the .opf file
+    :param backup_path: path to the folder with the unzipped copy
+    :return: bool
+    """
+    if not backup_path.is_dir():
+        return False
+
+    archive_mtime_ns = opf_path.stat().st_mtime_ns
+    # Sizes and mtimes first - that only needs a stat call
+    to_check = list()
+    for info in _members(opf_path):
+        member_path = backup_path / info.filename
+        if not member_path.is_file():
+            return False
+        stat = member_path.stat()
+        if stat.st_size != info.file_size:
+            return False
+        if stat.st_mtime_ns != archive_mtime_ns:
+            to_check.append(info)
+
+    return all(_crc32(backup_path / info.filename) == info.CRC for info in to_check)
+
+
+def extra_backup_files(opf_path: Path, backup_path: Path):
+    """
+    :return: sorted list of the files in the backup folder that are not in the archive
+    """
+    if not backup_path.is_dir():
+        return list()
+    filenames = {info.filename for info in _members(opf_path)}
+    relative_paths = {path.relative_to(backup_path).as_posix(): path
+                      for path in backup_path.rglob('*') if path.is_file()}
+    return sorted(path for filename, path in relative_paths.items()
+                  if filename not in filenames
+                  and not any(filename.startswith(prefix) for prefix in OPFFile.SKIP_PREFIXES))
+
+
+def _stamp(backup_path: Path, filenames, mtime_ns):
+    # Marks the backup files as copies of the archive version with this mtime
+    for filename in filenames:
+        os.utime(backup_path / filename, ns=(mtime_ns, mtime_ns))
+
+
+def _sync_one(opf_path: Path, backup_dir: Path):
+    """
+    :return: (whether the backup was (re-)written, list of the backup files that are not in the archive)
+    """
+    backup_path = backup_path_for(opf_path, backup_dir)
+    # Taken before anything is read: if the archive changes in the meantime, the next sync checks the CRCs again
+    mtime_ns = opf_path.stat().st_mtime_ns
+    extra_files = extra_backup_files(opf_path, backup_path)
+    if is_backup_up_to_date(opf_path, backup_path):
+        # The same contents but different mtimes, e.g., after a git checkout - no need for the CRCs next time
+        _stamp(backup_path, [info.filename for info in _members(opf_path)], mtime_ns)
+        return False, extra_files
+    opf_file = OPFFile(opf_path)
+    opf_file.write(path=backup_path, unzipped=True)
+    _stamp(backup_path, opf_file.filenames_in_archive, mtime_ns)
+    return True, extra_files
+
+
+def sync_to_backup(opf_paths, backup_dir: Path, max_workers=8):
+    """
+    Writes unzipped copies of the opf files that differ from their backups. Replaces cp_all_opf.sh. Files in the
+    backups that are not in the archives are listed but not deleted.
+    :param opf_paths: paths to the .opf files
+    :param backup_dir: the backup repo folder, each opf file is unzipped to backup_dir / <opf file stem>
+    :param max_workers: number of files checked/written concurrently
+    :return: list of the paths of the opf files that were (re-)written
+    """
+    opf_paths = list(opf_paths)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(lambda opf_path: _sync_one(opf_path, backup_dir), opf_paths))
+
+    extra_files = [path for _, paths in results for path in paths]
+    if extra_files:
+        print(f'{len(extra_files)} files in the backup are not in the opf files:')
+        for path in extra_files:
+            print(f'  {path}')
+
+    return [opf_path for opf_path, (was_changed, _) in zip(opf_paths, results) if was_changed]
@@ -0,0 +1,70 @@
+import random
+from pathlib import Path
+from zipfile import ZipFile, ZIP_DEFLATED
+
+
+PREFIX = '#4'
+COLUMN_DEFINITIONS = ('labeled_object (MATRIX,true,)-object|NOMINAL,utterance_type|NOMINAL,object_present|NOMINAL,'
+                      'speaker|NOMINAL,id|NOMINAL,pho|NOMINAL')
+PROJECT = '!project\nversion: 5\nviewerSettings: []\n'
+
+SPEAKERS = ('CHI', 'MOT', 'FAT', 'SIS', 'BRO', 'GRM')
+OBJECTS = ('ball', 'dog', 'bottle', 'banana', 'car', 'big\\, red ball', 'mama\\, look')
+TRANSCRIPTIONS = ('bal', 'dag', 'baba', 'nana', 'ka', '')
+
+
+def format_time(milliseconds):
+    seconds, ms = divmod(milliseconds, 1000)
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours:02}:{minutes:02}:{seconds:02}:{ms:03}'
+
+
+def make_db(n_cells, seed=0, pho_cell_rate=0.3, pho_field_rate=0.2):
+    """
+    Generates the text of a datavyu "db" file with a single "labeled_object" column that has a pho field.
+    CHI cells are followed by %pho cells at a nearby timestamp at the pho_cell_rate, CHI cells have their pho field
+    filled at the pho_field_rate. Some of the objects contain escaped commas.
+    :param n_cells: approximate number of cells, including the %pho cells
+    :param seed: random seed
+    :return: str
+    """
+    rng = random.Random(seed)
+    lines = [PREFIX, COLUMN_DEFINITIONS]
+
+    def annotid():
+        return f'0x{rng.getrandbits(24):06x}'
+
+    time = 0
+    while len(lines) - 2 < n_cells:
+        time += rng.randint(200, 5000)
+        start, end = format_time(time), format_time(time + rng.randint(100, 1500))
+        speaker = rng.choice(SPEAKERS)
+        pho = ''
+        if speaker == 'CHI' and rng.random() < pho_field_rate:
+            pho = f'%pho: {rng.choice(TRANSCRIPTIONS)}'
+        utterance_type, object_present = rng.choice('dqrsin'), rng.choice('yn')
+        lines.append(f'{start},{end},({rng.choice(OBJECTS)},{utterance_type},{object_present},{speaker},{annotid()},'
+                     f'{pho})')
+
+        if speaker == 'CHI' and rng.random() < pho_cell_rate:
+            # Pho cells end close to the CHI cell but not necessarily at the same time
+            pho_end = format_time(time + rng.randint(100, 1500) + rng.randint(-200, 200))
+            lines.append(f'{start},{pho_end},(%pho: {rng.choice(TRANSCRIPTIONS)},NA,NA,NA,{annotid()},)')
+
+    return '\n'.join(lines) + '\n'
+
+
+def write_synthetic_opf(path: Path, n_cells, seed=0, extra_bytes=0, **kwargs):
+    """
+    Writes an opf archive with a synthetic db, the "project" file and, if extra_bytes > 0, an additional member of
+    that size.
+    :param kwargs: passed to make_db
+    :return: path
+    """
+    with ZipFile(path, mode='w', compression=ZIP_DEFLATED) as opf_zipped:
+        opf_zipped.writestr('db', make_db(n_cells, seed=seed, **kwargs))
+        opf_zipped.writestr('project', PROJECT)
+        if extra_bytes:
+            opf_zipped.writestr('extra', random.Random(seed).randbytes(extra_bytes))
+    return path
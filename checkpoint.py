@@ -0,0 +1,151 @@
+"""
+Checkpointed batch runs over the corpus for the --batch mode of the drivers.
+
+Each file is processed on its own and a failure is recorded instead of stopping the run. The outcome of every file is
+appended to a journal in the checkpoint folder as soon as it is known, and the results of the successful files are
+pickled next to it. A rerun with the same checkpoint folder loads the results of the files that were done and have not
+changed since, and only processes the files that failed, changed, or are new.
+
+    checkpoint/
+        journal.jsonl - one line per processed file: path, size, mtime, and the error if it failed
+        results/<sha1 of the path>.pkl - what the processing function returned
+"""
+import json
+import pickle
+import hashlib
+import traceback
+from collections import namedtuple
+from pathlib import Path
+
+import pandas as pd
+
+from prefetch import PrefetchingReader, read_bytes
+
+
+Failure = namedtuple('Failure', ['file_path', 'error_type', 'error'])
+ERROR_REPORT_COLUMNS = Failure._fields
+
+
+def _signature(path: Path):
+    """
+    :return: (mtime_ns, size) or (None, None) if the file does not exist
+    """
+    try:
+        stat = Path(path).stat()
+    except FileNotFoundError:
+        return None, None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class Checkpoint(object):
+    def __init__(self, checkpoint_dir: Path):
+        self.checkpoint_dir = Path(checkpoint_dir)
+        self.results_dir = self.checkpoint_dir / 'results'
+        self.results_dir.mkdir(parents=True, exist_ok=True)
+        self.journal_path = self.checkpoint_dir / 'journal.jsonl'
+        # Latest record of each file
+        self.records = dict()
+        if self.journal_path.exists():
+            with self.journal_path.open('r', encoding='utf-8') as f:
+                for line in f:
+                    # The last line could have been cut short if the previous run was killed
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self.records[record['path']] = record
+
+    @staticmethod
+    def _key(path: Path):
+        return str(Path(path).absolute())
+
+    def _result_path(self, path: Path):
+        return self.results_dir / (hashlib.sha1(self._key(path).encode('utf-8')).hexdigest() + '.pkl')
+
+    def _append(self, record):
+        self.records[record['path']] = record
+        with self.journal_path.open('a', encoding='utf-8') as f:
+            f.write(json.dumps(record) + '\n')
+
+    def is_done(self, path: Path):
+        """
+        Was the file processed successfully and hasn't changed since?
+        """
+        record = self.records.get(self._key(path))
+        if record is None or record['error'] is not None:
+            return False
+        signature = _signature(path)
+        return signature != (None, None) and (record['mtime_ns'], record['size']) == signature
+
+    def load_result(self, path: Path):
+        with self._result_path(path).open('rb') as f:
+            return pickle.load(f)
+
+    def mark_done(self, path: Path, result, signature=None):
+        """
+        :param signature: (mtime_ns, size) of the file when it was read, so that a change made while the file was being
+        processed isn't marked as done. Taken now if None.
+        """
+        # The result goes first so that a file is never marked as done without one
+        with self._result_path(path).open('wb') as f:
+            pickle.dump(result, f)
+        mtime_ns, size = signature or _signature(path)
+        self._append(dict(path=self._key(path), mtime_ns=mtime_ns, size=size, error=None, error_type=None))
+
+    def mark_failed(self, path: Path, error: Exception, signature=None):
+        mtime_ns, size = signature or _signature(path)
+        self._append(dict(path=self._key(path), mtime_ns=mtime_ns, size=size,
+                          error=str(error) or traceback.format_exception_only(type(error), error)[-1].strip(),
+                          error_type=type(error).__name__))
+
+
+def run_batch(paths, process, checkpoint: Checkpoint, read=None):
+    """
+    Processes the files that are not done yet, one at a time, recording the outcome of each.
+    :param paths: paths of the files
+    :param process: function that takes a path and its contents (bytes) and returns a picklable result or raises an
+    exception if there is something wrong with the file
+    :param checkpoint: Checkpoint object
+    :param read: function that takes a path and returns bytes, passed to PrefetchingReader
+    :return: (dict path -> result for the successful files in the order of paths, list of Failure)
+    """
+    paths = list(paths)
+    to_process = [path for path in paths if not checkpoint.is_done(path)]
+    print(f'{len(paths) - len(to_process)} files done in a previous run, {len(to_process)} to process')
+
+    # Taken right before each file is read: a file changed after that will be processed again by the next run
+    signatures = dict()
+    read = read or read_bytes
+
+    def read_with_signature(path):
+        signatures[path] = _signature(path)
+        return read(path)
+
+    new_results, failures = dict(), list()
+    reader = PrefetchingReader(to_process, read=read_with_signature)
+    for i, (path, data, error) in enumerate(reader.iter_with_errors()):
+        end = '\n' if i % 20 == 19 else ' '
+        print(f'{i:03}', end=end)
+        signature = signatures.pop(path, None)
+        try:
+            if error is not None:
+                raise error
+            result = process(path, data)
+        except Exception as e:
+            checkpoint.mark_failed(path, e, signature=signature)
+            failures.append(Failure(file_path=Path(path).absolute(), error_type=type(e).__name__, error=str(e)))
+            continue
+        checkpoint.mark_done(path, result, signature=signature)
+        new_results[path] = result
+    print()
+
+    results = {path: new_results[path] if path in new_results else checkpoint.load_result(path)
+               for path in paths if path in new_results or checkpoint.is_done(path)}
+    return results, failures
+
+
+def write_error_report(failures, path: Path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    pd.DataFrame(columns=ERROR_REPORT_COLUMNS, data=failures).to_csv(path, index=False)
+    if failures:
+        print(f'{len(failures)} files failed, see {path.absolute()}')
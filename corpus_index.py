@@ -0,0 +1,195 @@
+"""
+SQLite index of the processing results for both corpora, for ad-hoc queries such as
+
+    -- CHI words still not transcribed
+    SELECT path, word, annotid FROM cha_words WHERE speaker = 'CHI' AND pho_state = 'not transcribed';
+    -- OPF CHI cells without a pho field
+    SELECT path, id, object FROM opf_chis WHERE is_pho_field = 0;
+
+The index is updated one file at a time: rows of a file are only replaced if the file has changed since it was indexed
+(see CorpusIndex.is_up_to_date).
+"""
+import sqlite3
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS cha_words (
+    path TEXT NOT NULL,
+    tier_index INTEGER NOT NULL,
+    speaker TEXT NOT NULL,
+    word TEXT NOT NULL,
+    annotid TEXT NOT NULL,
+    transcription TEXT,
+    -- ipa, not transcribed, error or missing (no transcription for this word)
+    pho_state TEXT NOT NULL,
+    -- result of MainTier.update_pho for the tier
+    status TEXT
+);
+CREATE INDEX IF NOT EXISTS cha_words_path ON cha_words (path);
+CREATE INDEX IF NOT EXISTS cha_words_speaker ON cha_words (speaker);
+CREATE INDEX IF NOT EXISTS cha_words_annotid ON cha_words (annotid);
+CREATE INDEX IF NOT EXISTS cha_words_status ON cha_words (status);
+CREATE INDEX IF NOT EXISTS cha_words_pho_state ON cha_words (pho_state);
+
+CREATE TABLE IF NOT EXISTS opf_chis (
+    path TEXT NOT NULL,
+    id TEXT,
+    time_start TEXT,
+    time_end TEXT,
+    object TEXT,
+    speaker TEXT,
+    pho TEXT,
+    object_pho TEXT,
+    id_pho TEXT,
+    time_start_pho TEXT,
+    time_end_pho TEXT,
+    is_pho_cell INTEGER,
+    is_pho_cell_filled INTEGER,
+    is_pho_field INTEGER,
+    is_pho_field_filled INTEGER
+);
+CREATE INDEX IF NOT EXISTS opf_chis_path ON opf_chis (path);
+CREATE INDEX IF NOT EXISTS opf_chis_speaker ON opf_chis (speaker);
+CREATE INDEX IF NOT EXISTS opf_chis_id ON opf_chis (id);
+CREATE INDEX IF NOT EXISTS opf_chis_id_pho ON opf_chis (id_pho);
+CREATE INDEX IF NOT EXISTS opf_chis_pho_fill ON opf_chis (is_pho_field, is_pho_field_filled);
+"""
+
+OPF_COLUMNS = ['id', 'time_start', 'time_end', 'object', 'speaker', 'pho', 'object_pho', 'id_pho',
+               'time_start_pho', 'time_end_pho',
+               'is_pho_cell', 'is_pho_cell_filled', 'is_pho_field', 'is_pho_field_filled']
+
+
+def _to_sql_value(value):
+    if value is None or value is pd.NaT:
+        return None
+    try:
+        if pd.isna(value):
+            return None
+    except (TypeError, ValueError):
+        pass
+    if isinstance(value, (bool, np.bool_, np.integer)):
+        return int(value)
+    if isinstance(value, np.floating):
+        return float(value)
+    if isinstance(value, (int, float, str)):
+        return value
+    # Times, etc.
+    return str(value)
+
+
+class CorpusIndex(object):
+    def __init__(self, db_path: Path):
+        self.db_path = db_path
+        self.connection = sqlite3.connect(str(db_path))
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @staticmethod
+    def _key(path: Path):
+        return str(Path(path).absolute())
+
+    def is_up_to_date(self, path: Path):
+        """
+        Was the file indexed after it was last changed?
+        """
+        row = self.connection.execute('SELECT mtime_ns, size FROM files WHERE path = ?', (self._key(path),)).fetchone()
+        if row is None:
+            return False
+        stat = Path(path).stat()
+        return tuple(row) == (stat.st_mtime_ns, stat.st_size)
+
+    def changed_paths(self, paths):
+        """
+        :return: the paths that are not in the index or have changed since they were indexed
+        """
+        return [path for path in paths if not self.is_up_to_date(path)]
+
+    def _replace_file(self, path, kind, table, rows):
+        key = self._key(path)
+        stat = Path(path).stat()
+        with self.connection:
+            self.connection.execute(f'DELETE FROM {table} WHERE path = ?', (key,))
+            if rows:
+                placeholders = ', '.join(['?'] * (len(rows[0]) + 1))
+                self.connection.executemany(f'INSERT INTO {table} VALUES ({placeholders})',
+                                            [(key, *row) for row in rows])
+            self.connection.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+                                    (key, kind, stat.st_mtime_ns, stat.st_size))
+
+    def index_cha_file(self, cha_file, speaker_code):
+        """
+        Replaces the rows of a cha file. The file should have been processed with
+        CHAFile.process_for_phonetic_transcription (and MainTier.update_pho for the status to be filled).
+        :param cha_file: CHAFile object
+        :param speaker_code: the speaker the file was processed for - the one the transcriptions are for
+        """
+        rows = list()
+        for tier_index, mt in enumerate(cha_file.main_tiers):
+            words = mt.words_uttered_by.get(speaker_code, [])
+            annotids = mt.annotid_of_words_uttered_by.get(speaker_code, [])
+            # An unequal number of transcriptions and words is an error that update_pho reports
+            transcriptions = mt.transcriptions or []
+            kinds = mt.transcription_kinds or []
+            for i, (word, annotid) in enumerate(zip(words, annotids)):
+                transcription = transcriptions[i] if i < len(transcriptions) else None
+                pho_state = kinds[i] if i < len(kinds) else 'missing'
+                rows.append((tier_index, speaker_code, word, annotid, transcription, pho_state, mt.pho_status))
+
+        self._replace_file(cha_file.path, 'cha', 'cha_words', rows)
+
+    def index_opf_file(self, path, chis_with_phos: pd.DataFrame):
+        """
+        Replaces the rows of an opf file.
+        :param path: path to the opf file
+        :param chis_with_phos: rows of this file from the output of opf_reports.add_flags (collect_all_chi + add_flags)
+        """
+        chis_with_phos = chis_with_phos.reindex(columns=OPF_COLUMNS)
+        # collect_all_chi added a random date to time_end for technical reasons, we don't need it here
+        for column in ('time_end', 'time_end_pho'):
+            if pd.api.types.is_datetime64_any_dtype(chis_with_phos[column]):
+                chis_with_phos[column] = chis_with_phos[column].dt.time
+        rows = [tuple(map(_to_sql_value, row)) for row in chis_with_phos.itertuples(index=False)]
+        self._replace_file(path, 'opf', 'opf_chis', rows)
+
+    def index_opf_files(self, all_chis_with_phos: pd.DataFrame, paths=None):
+        """
+        Replaces the rows of several opf files at once.
+        :param all_chis_with_phos: flagged table with the file_path column, e.g., OPFReports.full
+        :param paths: files to index, all the files in the table by default. Files without any rows are indexed as
+        having no CHI cells.
+        """
+        by_path = dict(list(all_chis_with_phos.groupby('file_path', sort=False)))
+        for path in (paths if paths is not None else by_path):
+            self.index_opf_file(path, by_path.get(path, all_chis_with_phos.iloc[:0]))
+
+    def remove(self, path):
+        key = self._key(path)
+        with self.connection:
+            for table in ('cha_words', 'opf_chis', 'files'):
+                self.connection.execute(f'DELETE FROM {table} WHERE path = ?', (key,))
+
+    def query(self, sql, parameters=()):
+        """
+        :return: the result as a dataframe
+        """
+        return pd.read_sql_query(sql, self.connection, params=parameters)
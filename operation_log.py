@@ -0,0 +1,107 @@
+"""
+Log of the edits made to the cha and opf files, replayable onto the originals or onto their backups.
+
+Instead of regenerating whole files and diffing them against the backups, the scripts record what they change, e.g.,
+"set the pho field of the opf cell with id X" or "set the %pho: subtier of the cha tier with annotid Y". The log is
+saved as json lines, one operation per line. Replaying it only loads the files the operations are for and only writes
+the ones that actually changed. Each operation checks the current state first, so replaying the same log twice (or
+onto files that already have some of the changes) changes nothing the second time.
+
+The operations themselves are applied by the format-specific modules:
+    add_pho_to_cha/cha_operations.py - names starting with "cha."
+    add_pho_top_opf/opf_operations.py - names starting with "opf."
+"""
+import json
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+
+# name: "<format>.<operation>", e.g. "opf.drop_cell"
+# path: the file the operation was recorded for
+# arguments: dict with the rest, e.g., {"id": "0x1a2b3c"}
+Operation = namedtuple('Operation', ['name', 'path', 'arguments'])
+
+
+def format_of(operation: Operation):
+    return operation.name.split('.', maxsplit=1)[0]
+
+
+class OperationLog(object):
+    def __init__(self, operations=None):
+        self.operations = list(operations or [])
+
+    def append(self, name, path, /, **arguments):
+        # Positional-only so that the arguments can include "name" and "path"
+        self.operations.append(Operation(name=name, path=Path(path), arguments=arguments))
+
+    def extend(self, operations):
+        self.operations.extend(operations)
+
+    def __iter__(self):
+        return iter(self.operations)
+
+    def __len__(self):
+        return len(self.operations)
+
+    def save(self, log_path: Path, append=False):
+        """
+        Writes the operations as json lines.
+        :param log_path: where to write the log
+        :param append: add to an existing log instead of overwriting it
+        """
+        log_path.parent.mkdir(parents=True, exist_ok=True)
+        with log_path.open('a' if append else 'w', encoding='utf-8') as f:
+            for operation in self.operations:
+                f.write(json.dumps({'name': operation.name,
+                                    'path': str(operation.path),
+                                    'arguments': operation.arguments},
+                                   ensure_ascii=False) + '\n')
+
+    @classmethod
+    def load(cls, log_path: Path):
+        with log_path.open('r', encoding='utf-8') as f:
+            records = [json.loads(line) for line in f if line.strip()]
+        return cls(Operation(name=record['name'], path=Path(record['path']), arguments=record['arguments'])
+                   for record in records)
+
+    def by_path(self):
+        """
+        Groups the operations by the file they were recorded for, keeping the order within each file.
+        :return: dict path -> list of Operation
+        """
+        by_path = dict()
+        for operation in self.operations:
+            by_path.setdefault(operation.path, list()).append(operation)
+        return by_path
+
+
+def replay(operations, appliers, target_for=None, max_workers=8):
+    """
+    Applies the operations file by file. Each file is loaded once, all of its operations are applied in the order they
+    were recorded, and the file is only written if any of them changed something.
+    :param operations: OperationLog or any iterable of Operation objects
+    :param appliers: dict format -> function(target_path, operations) returning whether the file has changed, e.g.,
+    {'opf': opf_operations.apply_operations}
+    :param target_for: function mapping the path an operation was recorded for to the path of the file to apply it to,
+    e.g., to the backup copy. By default, the operations are applied to the files they were recorded for.
+    :param max_workers: number of files updated concurrently
+    :return: dict target path -> bool, whether the file has changed
+    """
+    log = operations if isinstance(operations, OperationLog) else OperationLog(operations)
+    by_path = log.by_path()
+    for path, file_operations in by_path.items():
+        formats = set(map(format_of, file_operations))
+        if len(formats) > 1:
+            raise ValueError(f'Operations of different formats recorded for {path}: {sorted(formats)}')
+        [format_] = formats
+        if format_ not in appliers:
+            raise ValueError(f'Don\'t know how to apply the {format_} operations recorded for {path}')
+
+    def replay_one(path):
+        file_operations = by_path[path]
+        target_path = target_for(path) if target_for else path
+        return target_path, appliers[format_of(file_operations[0])](target_path, file_operations)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(executor.map(replay_one, by_path))
@@ -0,0 +1,113 @@
+"""
+Reading many files from a network share one at a time means waiting for the full network latency for each of them.
+PrefetchingReader reads the upcoming files concurrently while the current one is being processed and hands them over
+in the original order.
+
+Used by both the CHA and the OPF drivers:
+    for path, data in PrefetchingReader(paths):
+        cha_file = CHAFile(path, data=data)
+"""
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+
+def read_bytes(path):
+    return Path(path).read_bytes()
+
+
+def with_latency(read, seconds):
+    """
+    Wraps a read function to wait before each read - to simulate a network share with a local folder.
+    :param read: function that takes a path and returns bytes
+    :param seconds: latency
+    :return: function
+    """
+    def read_with_latency(path):
+        time.sleep(seconds)
+        return read(path)
+    return read_with_latency
+
+
+class PrefetchingReader(object):
+    def __init__(self, paths, max_workers=8, max_files_ahead=None, max_bytes_in_flight=256 * 2 ** 20,
+                 read=read_bytes):
+        """
+        :param paths: paths to read, in the order they should be handed over
+        :param max_workers: number of concurrent reads
+        :param max_files_ahead: how many files can be read or being read ahead of the current one, 2 * max_workers by
+        default
+        :param max_bytes_in_flight: no new reads are started while the files that were read but not yet handed over
+        take up at least this many bytes. At least one file is always read ahead so that a large file can't block the
+        reader.
+        :param read: function that takes a path and returns bytes
+        """
+        self.paths = paths
+        self.max_workers = max_workers
+        self.max_files_ahead = max_files_ahead or 2 * max_workers
+        self.max_bytes_in_flight = max_bytes_in_flight
+        self.read = read
+
+        self._lock = threading.Lock()
+        self._bytes_in_flight = 0
+
+    def _read(self, path):
+        data = self.read(path)
+        with self._lock:
+            self._bytes_in_flight += len(data)
+        return data
+
+    def _can_read_ahead(self, window):
+        if not window:
+            return True
+        with self._lock:
+            bytes_in_flight = self._bytes_in_flight
+        return len(window) < self.max_files_ahead and bytes_in_flight < self.max_bytes_in_flight
+
+    def __iter__(self):
+        """
+        :return: generator of (path, data) tuples in the order of self.paths. Stops with the error of the first file
+        that can't be read.
+        """
+        for path, data, error in self.iter_with_errors():
+            if error is not None:
+                raise error
+            yield path, data
+
+    def iter_with_errors(self):
+        """
+        Same as iterating over self but a file that can't be read doesn't stop the iteration.
+        :return: generator of (path, data, error) tuples in the order of self.paths. data is None if reading the file
+        raised an exception, error is that exception or None.
+        """
+        paths = iter(self.paths)
+        window = deque()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            try:
+                exhausted = False
+                while True:
+                    while not exhausted and self._can_read_ahead(window):
+                        path = next(paths, None)
+                        if path is None:
+                            exhausted = True
+                        else:
+                            window.append((path, executor.submit(self._read, path)))
+
+                    if not window:
+                        return
+
+                    path, future = window.popleft()
+                    try:
+                        data = future.result()
+                    except Exception as e:
+                        yield path, None, e
+                        continue
+                    with self._lock:
+                        self._bytes_in_flight -= len(data)
+                    yield path, data, None
+            finally:
+                # Don't start the reads that haven't started if we stopped early
+                for _, future in window:
+                    future.cancel()
@@ -0,0 +1,148 @@
+"""
+Reconciles the transcriptions of the same recordings annotated in both formats: the %pho: subtiers of the cha files
+(words are identified by the annotids in &=..._CHI_0x......) and the pho fields of the opf files (identified by the id
+column).
+
+Files are paired by the recording prefix of their names (e.g., 01_12 in 01_12_sparse_code.cha and
+01_12_sparse_code.opf) and processed in batches of recordings so that only a batch worth of files is in memory at a
+time.
+
+Usage:
+    python reconcile.py cha_paths.txt opf_paths.txt reports/reconciliation.csv
+"""
+import re
+import sys
+import argparse
+from pathlib import Path
+
+import pandas as pd
+
+
+RECORDING_PATTERN = re.compile(r'^(\d{2}_\d{2})')
+NOT_TRANSCRIBED = ('', '###')
+
+COLUMNS = ['recording', 'annotid', 'status', 'cha_transcription', 'opf_transcription', 'cha_path', 'opf_path']
+
+
+def recording_of(path: Path):
+    match = RECORDING_PATTERN.match(Path(path).name)
+    if not match:
+        raise ValueError(f'Can\'t find the recording prefix in {path}')
+    return match.group(1)
+
+
+def _normalize(transcription):
+    if transcription is None or transcription in NOT_TRANSCRIBED:
+        return None
+    return transcription
+
+
+def join_transcriptions(cha_transcriptions: dict, opf_transcriptions: dict):
+    """
+    Joins two annotid -> transcription indexes.
+    :return: generator of (annotid, status, cha transcription, opf transcription) for everything but the annotations
+    that agree - have the same transcription or aren't transcribed in either file
+    """
+    for annotid in sorted(cha_transcriptions.keys() | opf_transcriptions.keys()):
+        in_cha, in_opf = annotid in cha_transcriptions, annotid in opf_transcriptions
+        cha_transcription = _normalize(cha_transcriptions.get(annotid))
+        opf_transcription = _normalize(opf_transcriptions.get(annotid))
+
+        if not in_opf:
+            status = 'only in cha'
+        elif not in_cha:
+            status = 'only in opf'
+        elif cha_transcription == opf_transcription:
+            continue
+        elif opf_transcription is None:
+            status = 'not transcribed in opf'
+        elif cha_transcription is None:
+            status = 'not transcribed in cha'
+        else:
+            status = 'different'
+
+        yield annotid, status, cha_transcription, opf_transcription
+
+
+def pair_by_recording(cha_paths, opf_paths):
+    """
+    :return: list of (recording, cha_path or None, opf_path or None) sorted by recording
+    """
+    pairs = dict()
+    for index, paths in enumerate((cha_paths, opf_paths)):
+        for path in paths:
+            recording = recording_of(path)
+            pair = pairs.setdefault(recording, [None, None])
+            if pair[index] is not None:
+                raise ValueError(f'Multiple files for recording {recording}: {pair[index]}, {path}')
+            pair[index] = path
+    return [(recording, cha_path, opf_path) for recording, (cha_path, opf_path) in sorted(pairs.items())]
+
+
+def reconcile(cha_paths, opf_paths, load_cha_transcriptions, load_opf_transcriptions, batch_size=50):
+    """
+    :param cha_paths: paths to the cha files
+    :param opf_paths: paths to the opf files
+    :param load_cha_transcriptions: function that takes a cha path and returns an annotid -> transcription dict
+    :param load_opf_transcriptions: function that takes an opf path and returns an id -> transcription dict
+    :param batch_size: number of recordings loaded at a time
+    :return: generator of dataframes with COLUMNS, one per batch
+    """
+    pairs = pair_by_recording(cha_paths, opf_paths)
+    for batch_start in range(0, len(pairs), batch_size):
+        rows = list()
+        for recording, cha_path, opf_path in pairs[batch_start:batch_start + batch_size]:
+            cha_transcriptions = load_cha_transcriptions(cha_path) if cha_path else dict()
+            opf_transcriptions = load_opf_transcriptions(opf_path) if opf_path else dict()
+            rows.extend((recording, annotid, status, cha_transcription, opf_transcription, cha_path, opf_path)
+                        for annotid, status, cha_transcription, opf_transcription
+                        in join_transcriptions(cha_transcriptions, opf_transcriptions))
+        yield pd.DataFrame(columns=COLUMNS, data=rows)
+
+
+def write_report(batches, output_path: Path):
+    """
+    Writes the batches to a single csv file as they come.
+    :return: number of rows written
+    """
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    n_rows = 0
+    for i, batch in enumerate(batches):
+        batch.to_csv(output_path, index=False, mode='w' if i == 0 else 'a', header=(i == 0))
+        n_rows += len(batch)
+    return n_rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the transcriptions in the cha and opf files.')
+    parser.add_argument('cha_path_list', type=Path, help='File with the cha paths, one per line')
+    parser.add_argument('opf_path_list', type=Path, help='File with the opf paths, one per line')
+    parser.add_argument('output_path', type=Path, help='Where to write the csv report')
+    parser.add_argument('--speaker', default='CHI')
+    parser.add_argument('--batch-size', type=int, default=50, help='Number of recordings loaded at a time')
+    args = parser.parse_args()
+
+    # The parsers live in their own folders and import their neighbours by name
+    repo_path = Path(__file__).parent
+    sys.path[:0] = [str(repo_path / 'add_pho_to_cha'), str(repo_path / 'add_pho_top_opf')]
+    from cha import CHAFile
+    from opf import OPFFile, OPFDataFrame
+    from opf_reports import transcriptions_by_id
+    from shards import read_paths
+
+    def load_cha_transcriptions(path):
+        cha_file = CHAFile(path)
+        cha_file.process_for_phonetic_transcription(args.speaker)
+        return cha_file.transcriptions_by_annotid(args.speaker)
+
+    def load_opf_transcriptions(path):
+        return transcriptions_by_id(OPFDataFrame(OPFFile(path, load_db=False)), speaker=args.speaker)
+
+    batches = reconcile(read_paths(args.cha_path_list), read_paths(args.opf_path_list),
+                        load_cha_transcriptions, load_opf_transcriptions, batch_size=args.batch_size)
+    n_rows = write_report(batches, args.output_path)
+    print(f'{n_rows} mismatches written to {args.output_path}')
+
+
+if __name__ == '__main__':
+    main()
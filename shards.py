@@ -0,0 +1,127 @@
+"""
+Splitting the path lists between several machines (or processes) and merging the partial outputs.
+
+Shard i/N gets the i-th of N contiguous, nearly equal blocks of the path list. Merging the partial outputs of the
+shards in the order 0, 1, ..., N-1 therefore results in the same rows in the same order as processing all the paths
+in one go. Instead of a shard, a driver can also be given an explicit list of paths.
+
+Whatever order the shard output folders are listed in, they are merged in the order of the numbers in their names,
+e.g., shard_2 before shard_10, so name them after the shard index (or the position of the path list).
+"""
+import re
+import argparse
+from pathlib import Path
+
+
+def add_shard_arguments(parser: argparse.ArgumentParser):
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--shard', type=parse_shard, help='Process only shard i of N, e.g., 0/4')
+    group.add_argument('--paths', type=Path, help='Process only the paths listed in this file, one per line')
+    group.add_argument('--merge', type=Path, nargs='+', metavar='SHARD_OUTPUT_DIR',
+                       help='Don\'t process anything, merge the outputs of the shards written to these folders')
+    parser.add_argument('--path-list', type=Path, default=None,
+                        help='File with the full list of paths to use instead of the default one')
+    parser.add_argument('--output-dir', type=Path, default=None, help='Where to write the outputs')
+
+
+def parse_args(description, add_arguments=None):
+    """
+    Parses the shard arguments. The shard output folders to merge are sorted, see shard_dir_order.
+    :param description: description of the driver
+    :param add_arguments: optional function that adds driver-specific arguments to the parser
+    :return: argparse.Namespace
+    """
+    parser = argparse.ArgumentParser(description=description)
+    add_shard_arguments(parser)
+    if add_arguments:
+        add_arguments(parser)
+    args = parser.parse_args()
+    if args.merge:
+        args.merge = sorted(args.merge, key=shard_dir_order)
+    return args
+
+
+def shard_dir_order(shard_dir: Path):
+    """
+    Sort key that compares the numbers in the folder paths as numbers, e.g., shard_2 goes before shard_10.
+    """
+    return [(0, int(part), '') if part.isdigit() else (1, 0, part)
+            for part in re.split(r'(\d+)', Path(shard_dir).as_posix()) if part]
+
+
+def parse_shard(text):
+    """
+    :param text: 'i/N'
+    :return: (i, N)
+    """
+    try:
+        index, count = map(int, text.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'Shard must be in the i/N format, got {text}')
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f'Shard index must be between 0 and {count - 1}, got {index}')
+    return index, count
+
+
+def select_shard(paths, shard):
+    """
+    :param paths: list of paths
+    :param shard: (i, N)
+    :return: the i-th of the N contiguous blocks of paths
+    """
+    index, count = shard
+    start, end = len(paths) * index // count, len(paths) * (index + 1) // count
+    return paths[start:end]
+
+
+def read_paths(path_list_path: Path):
+    with path_list_path.open('r', encoding='utf-8') as f:
+        return [Path(line.rstrip()) for line in f if line.strip()]
+
+
+def is_sharded(args):
+    return args.shard is not None or args.paths is not None
+
+
+def paths_to_process(args, all_paths):
+    """
+    :param args: parsed arguments
+    :param all_paths: the full path list
+    :return: the paths the current shard should process
+    """
+    if args.shard is not None:
+        return select_shard(all_paths, args.shard)
+    if args.paths is not None:
+        return read_paths(args.paths)
+    return all_paths
+
+
+def merge_csvs(shard_dirs, filename, output_path: Path):
+    """
+    Concatenates the csv files with the same name from the shard output folders keeping only the first header.
+    Shards that didn't write the file are skipped. Nothing is written if none of the shards did.
+    :param shard_dirs: shard output folders, in the shard order
+    :param filename: name of the csv file
+    :param output_path: where to write the merged file
+    :return: number of the data rows written
+    """
+    header, rows = None, list()
+    for shard_dir in shard_dirs:
+        csv_path = Path(shard_dir) / filename
+        if not csv_path.exists():
+            continue
+        with csv_path.open('r', encoding='utf-8', newline='') as f:
+            shard_header, *shard_rows = f.readlines()
+        if header is not None and shard_header != header:
+            raise ValueError(f'{csv_path} has a different header: {shard_header}')
+        header = shard_header
+        rows.extend(shard_rows)
+
+    if header is None:
+        return 0
+
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    with output_path.open('w', encoding='utf-8', newline='') as f:
+        f.write(header)
+        f.writelines(rows)
+    return len(rows)
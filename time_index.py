@@ -0,0 +1,177 @@
+"""
+Finding intervals by time: the main tiers of a cha file that overlap a time range, and the pairs of cha tiers and opf
+cells that overlap each other.
+
+The queries take integer milliseconds: the cha timestamps already are, compacted OPFDataFrame objects store the opf
+times that way too. The joins also accept datavyu timestamp strings and datetimes, e.g., time_end in the output of
+collect_all_chi. Intervals are half-open - [start, end) - so that a tier ending exactly where the next one starts only
+overlaps one of them. Zero-length intervals are treated as lasting one millisecond.
+
+Example:
+    index = TimeIndex.from_frame(cha_file.tier_times())
+    tier_indices = index.overlapping(clock_to_milliseconds('01:02:03'), clock_to_milliseconds('01:02:05'))
+"""
+import re
+
+import numpy as np
+import pandas as pd
+
+
+CLOCK_PATTERN = re.compile(r'(?:(?P<hours>\d+):)?(?P<minutes>\d+):(?P<seconds>\d+)(?:[.:](?P<milliseconds>\d{1,3}))?')
+
+
+def clock_to_milliseconds(clock):
+    """
+    :param clock: 'HH:MM:SS', 'MM:SS', or either of them with milliseconds after a dot or a colon (datavyu)
+    :return: int
+    """
+    match = CLOCK_PATTERN.fullmatch(clock)
+    if match is None:
+        raise ValueError(f'Not a time: {clock}')
+    hours, minutes, seconds = (int(match.group(name) or 0) for name in ('hours', 'minutes', 'seconds'))
+    milliseconds = int((match.group('milliseconds') or '0').ljust(3, '0'))
+    return ((hours * 60 + minutes) * 60 + seconds) * 1000 + milliseconds
+
+
+def to_milliseconds(times: pd.Series):
+    """
+    :param times: integer milliseconds (can be floats, e.g., integers with NaN dropped), datetimes (only the time of
+    day is used), or timestamp strings
+    :return: int64 array
+    """
+    if pd.api.types.is_integer_dtype(times):
+        return times.to_numpy(dtype='int64')
+    if pd.api.types.is_float_dtype(times):
+        if times.isna().any():
+            raise ValueError('Missing times')
+        return times.to_numpy().astype('int64')
+    if pd.api.types.is_datetime64_any_dtype(times):
+        return ((times - times.dt.normalize()) // pd.Timedelta(milliseconds=1)).to_numpy(dtype='int64')
+
+    parts = times.astype(str).str.extract(f'^{CLOCK_PATTERN.pattern}$')
+    unparsed = parts.minutes.isna()
+    if unparsed.any():
+        raise ValueError(f'Not a time: {times[unparsed].iloc[0]}')
+    hours, minutes, seconds = (parts[name].fillna('0').astype('int64') for name in ('hours', 'minutes', 'seconds'))
+    milliseconds = parts.milliseconds.fillna('0').str.ljust(3, '0').astype('int64')
+    return (((hours * 60 + minutes) * 60 + seconds) * 1000 + milliseconds).to_numpy(dtype='int64')
+
+
+def _as_half_open(starts, ends):
+    starts = np.asarray(starts, dtype='int64')
+    ends = np.asarray(ends, dtype='int64')
+    if (ends < starts).any():
+        raise ValueError('Intervals can\'t end before they start')
+    return starts, np.maximum(ends, starts + 1)
+
+
+class TimeIndex(object):
+    """
+    Intervals sorted by their start with the running maximum of their ends, so that the ones overlapping a time range
+    are found with two binary searches and a scan of the candidates between them.
+    """
+    def __init__(self, starts, ends, labels=None):
+        """
+        :param starts: interval starts in milliseconds
+        :param ends: interval ends in milliseconds
+        :param labels: what the queries return for each interval, e.g., the main tier indices. Positions in starts if
+        None.
+        """
+        starts, ends = _as_half_open(starts, ends)
+        labels = np.arange(len(starts)) if labels is None else np.asarray(labels)
+        order = np.argsort(starts, kind='stable')
+        self.starts, self.ends, self.labels = starts[order], ends[order], labels[order]
+        # Everything before the first position where the running maximum exceeds the start of the query ends too early
+        self._max_ends = np.maximum.accumulate(self.ends)
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame, label_column=None):
+        """
+        :param df: dataframe with the time_start and time_end columns, e.g., CHAFile.tier_times(), see to_milliseconds
+        :param label_column: column with the labels, the index of df if None
+        """
+        labels = df.index.to_numpy() if label_column is None else df[label_column].to_numpy()
+        return cls(to_milliseconds(df.time_start), to_milliseconds(df.time_end), labels=labels)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def _candidate_ranges(self, starts, ends):
+        # Candidates: start before the query ends and sit after the last interval that ends before the query starts
+        lo = np.searchsorted(self._max_ends, starts, side='right')
+        hi = np.searchsorted(self.starts, ends, side='left')
+        return lo, np.maximum(hi, lo)
+
+    def overlapping(self, start, end):
+        """
+        :param start: start of the time range in milliseconds
+        :param end: end of the time range in milliseconds
+        :return: array of the labels of the overlapping intervals in the order of their starts
+        """
+        (start,), (end,) = _as_half_open([start], [end])
+        lo, hi = self._candidate_ranges(start, end)
+        candidates = slice(lo, hi)
+        return self.labels[candidates][self.ends[candidates] > start]
+
+    def overlapping_many(self, starts, ends):
+        """
+        Finds the overlapping intervals for many time ranges at once.
+        :param starts: starts of the time ranges in milliseconds
+        :param ends: ends of the time ranges in milliseconds
+        :return: (positions of the time ranges, labels of the intervals) - one element of each array per overlap, in
+        the order of the time ranges, then of the interval starts
+        """
+        starts, ends = _as_half_open(starts, ends)
+        lo, hi = self._candidate_ranges(starts, ends)
+        counts = hi - lo
+        query_positions = np.repeat(np.arange(len(starts)), counts)
+        # lo, lo + 1, ..., hi - 1 for each time range
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        interval_positions = np.repeat(lo, counts) + offsets
+        overlaps = self.ends[interval_positions] > starts[query_positions]
+        return query_positions[overlaps], self.labels[interval_positions[overlaps]]
+
+
+def join_by_overlap(left: pd.DataFrame, right: pd.DataFrame, suffixes=('', '_right')):
+    """
+    Pairs up the rows of two dataframes whose time intervals overlap. Rows with a missing time are skipped, e.g., the
+    orphan pho cells in the output of collect_all_chi.
+    :param left: dataframe with the time_start and time_end columns, see to_milliseconds
+    :param right: same
+    :param suffixes: added to the names of the columns that are in both dataframes
+    :return: dataframe with a row per overlapping pair: the columns of left, then the columns of right, with the
+    original indices in left_index and right_index
+
+    Example, with integer milliseconds that became floats because of an orphan cell:
+    >>> tiers = pd.DataFrame(dict(time_start=[0, 1000], time_end=[1000, 2000]))
+    >>> cells = pd.DataFrame(dict(time_start=[500, None, 1200], time_end=[1100, None, 1300], object=['a', 'b', 'c']))
+    >>> join_by_overlap(tiers, cells, suffixes=('', '_opf'))[['left_index', 'right_index', 'object']]
+       left_index  right_index object
+    0           0            0      a
+    1           1            0      a
+    2           1            2      c
+    """
+    left = left[left.time_start.notna() & left.time_end.notna()]
+    right = right[right.time_start.notna() & right.time_end.notna()]
+    index = TimeIndex(to_milliseconds(right.time_start), to_milliseconds(right.time_end))
+    left_positions, right_positions = index.overlapping_many(to_milliseconds(left.time_start),
+                                                             to_milliseconds(left.time_end))
+
+    left_rows = left.iloc[left_positions].rename_axis('left_index').reset_index()
+    right_rows = right.iloc[right_positions].rename_axis('right_index').reset_index()
+    common = set(left_rows.columns) & set(right_rows.columns)
+    left_rows.columns = [f'{column}{suffixes[0]}' if column in common else column for column in left_rows.columns]
+    right_rows.columns = [f'{column}{suffixes[1]}' if column in common else column for column in right_rows.columns]
+    return pd.concat([left_rows, right_rows], axis='columns')
+
+
+def join_tiers_to_cells(tier_times: pd.DataFrame, cells: pd.DataFrame):
+    """
+    Lines up the main tiers of a cha file with the opf cells of the same recording by time.
+    :param tier_times: output of CHAFile.tier_times()
+    :param cells: opf cells, e.g., OPFDataFrame.df or the output of collect_all_chi
+    :return: dataframe with a row per overlapping tier and cell: tier_index, time_start, and time_end of the tier, then
+    the cell columns with the '_opf' suffix for the times and any other shared names, and the index of the cell in
+    cells in right_index
+    """
+    return join_by_overlap(tier_times, cells, suffixes=('', '_opf'))
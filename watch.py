@@ -0,0 +1,117 @@
+"""
+Watching the annotation files for changes, for the --watch mode of the drivers.
+
+Changes are detected by comparing the size and the mtime of each file to the ones seen last time. By default, all the
+files are polled every few seconds - that is the only option that works on the network share. On Linux, if the
+optional inotify_simple package is installed, the folders of the files are watched with inotify instead, and only the
+files in the folders with events are checked.
+"""
+import time
+from pathlib import Path
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+
+def signature(path: Path):
+    """
+    :return: (mtime_ns, size) or None if the file does not exist
+    """
+    try:
+        stat = Path(path).stat()
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class ChangeWatcher(object):
+    def __init__(self, paths, use_inotify=True):
+        """
+        :param paths: files to watch
+        :param use_inotify: use inotify if inotify_simple is installed, poll otherwise
+        """
+        self.paths = list(paths)
+        self._signatures = {path: signature(path) for path in self.paths}
+        self._inotify = None
+        if use_inotify and inotify_simple is not None:
+            self._start_inotify()
+
+    def _start_inotify(self):
+        flags = inotify_simple.flags
+        self._inotify = inotify_simple.INotify()
+        self._paths_by_watch = dict()
+        paths_by_folder = dict()
+        for path in self.paths:
+            paths_by_folder.setdefault(Path(path).parent, list()).append(path)
+        for folder, paths in paths_by_folder.items():
+            # Editors often save by writing a new file and renaming it, hence the folders and not the files
+            watch_descriptor = self._inotify.add_watch(
+                folder, flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE | flags.DELETE | flags.MOVED_FROM)
+            self._paths_by_watch[watch_descriptor] = paths
+
+    @property
+    def uses_inotify(self):
+        return self._inotify is not None
+
+    def _changed(self, paths):
+        changed = list()
+        for path in paths:
+            new_signature = signature(path)
+            if new_signature != self._signatures[path]:
+                self._signatures[path] = new_signature
+                changed.append(path)
+        return changed
+
+    def changed_paths(self, timeout=0):
+        """
+        :param timeout: with inotify, how long to wait for the events, in seconds
+        :return: the paths that changed (or were deleted) since the last call, in the original order
+        """
+        if self._inotify is None:
+            return self._changed(self.paths)
+
+        events = self._inotify.read(timeout=int(timeout * 1000))
+        watched = {watch_descriptor for watch_descriptor in (event.wd for event in events)
+                   if watch_descriptor in self._paths_by_watch}
+        to_check = {path for watch_descriptor in watched for path in self._paths_by_watch[watch_descriptor]}
+        return self._changed([path for path in self.paths if path in to_check])
+
+    def close(self):
+        if self._inotify is not None:
+            self._inotify.close()
+
+
+def watch(paths, on_change, interval=2.0, use_inotify=True):
+    """
+    Calls on_change with the list of changed paths whenever any of the files change. Stops on Ctrl+C.
+    :param paths: files to watch
+    :param on_change: function that takes a list of paths
+    :param interval: seconds between the polls, or the longest wait for the inotify events
+    :param use_inotify: see ChangeWatcher
+    """
+    watcher = ChangeWatcher(paths, use_inotify=use_inotify)
+    print(f'Watching {len(watcher.paths)} files for changes, Ctrl+C to stop')
+    try:
+        while True:
+            if not watcher.uses_inotify:
+                time.sleep(interval)
+            changed = watcher.changed_paths(timeout=interval)
+            if changed:
+                start = time.perf_counter()
+                on_change(changed)
+                print(f'{len(changed)} changed files reprocessed in {time.perf_counter() - start:.1f} s')
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+
+def write_table(df, path: Path):
+    """
+    Replaces a csv output so that it is never seen half-written.
+    """
+    temp_path = path.with_name(f'.{path.name}.tmp')
+    df.to_csv(temp_path, index=False)
+    temp_path.replace(path)